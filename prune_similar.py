@@ -3,7 +3,7 @@ from multiprocessing import cpu_count
 from optparse import OptionParser
 from os.path import join
 
-from uDance.subsample_partition import subsample_partition
+from uDance.subsample_partition import prune_partitions
 
 
 if __name__ == '__main__':
@@ -16,6 +16,8 @@ if __name__ == '__main__':
                            "0 to use all cores in the running machine", metavar="NUMBER")
     parser.add_option("-S", "--size", type=int, dest="minimum_size", metavar='NUMBER', default=9000,
                       help="partition size requirement for pruning.")
+    parser.add_option("-M", "--memory", type=int, dest="memory", metavar='NUMBER', default=4000,
+                      help="memory budget in MBs for rewriting gene alignments in parallel.")
 
     (options, args) = parser.parse_args()
     if options.num_thread == 0:
@@ -25,7 +27,7 @@ if __name__ == '__main__':
     with open(outmap) as o:
         j = json.load(o)
     partition_dirs = [x for x in j.keys() if int(x) >= 0]
-    dupmapstrs = []
+    oversized = []
     for i in partition_dirs:
         partition_output_dir = join(options.output_fp, str(i))
         with open(join(partition_output_dir, "species.txt")) as f:
@@ -34,9 +36,9 @@ if __name__ == '__main__':
             if numspecies < options.minimum_size:
                 continue
         print(numspecies)
-        res = subsample_partition(partition_output_dir, options.minimum_size)
-        if res:
-            dupmapstrs.append(res)
+        oversized.append(partition_output_dir)
+    dupmapstrs = [res for res in prune_partitions(oversized, options.minimum_size, options.num_thread,
+                                                  options.memory * 1024 * 1024) if res]
 
     if len(dupmapstrs) > 0:
         with open(join(options.output_fp, "dedupe_map.txt"), "a") as f:
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+# Benchmark of the single-pass expand_dedupe_newick against the original implementation (which searches and
+# replaces over the whole tree string for every duplicate group), on a random tree with a large duplicate map.
+# usage: python scripts/bench_expand_dedupe.py [-n LEAVES] [-g GROUPS] [-d DUPLICATES]
+import argparse
+import random
+import sys
+import time
+from os.path import abspath, dirname
+
+import treeswift as ts
+
+# the uDance package is in the repository root, one level above this script
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from uDance.expand_dedupe_newick import expand_dedupe_newick
+
+
+def expand_dedupe_newick_legacy(treestr, dups):
+    for i in dups:
+        if len(i) >= 2:
+            if treestr.find('(' + i[0] + ':') != -1:
+                ex = '((' + ':0,'.join(i) + ':0)1:'
+                treestr = treestr.replace('(' + i[0] + ':', ex, 1)
+            elif treestr.find(',' + i[0] + ':') != -1:
+                ex = ',(' + ':0,'.join(i) + ':0)1:'
+                treestr = treestr.replace(',' + i[0] + ':', ex, 1)
+    return treestr
+
+
+def random_tree(num_leaves, seed):
+    rng = random.Random(seed)
+    nodes = [ts.Node(label='L%d' % i, edge_length=rng.random() / 10) for i in range(num_leaves)]
+    while len(nodes) > 1:
+        i = rng.randrange(len(nodes) - 1)
+        parent = ts.Node(label='%.2f' % rng.random(), edge_length=rng.random() / 10)
+        parent.add_child(nodes[i])
+        parent.add_child(nodes.pop())
+        nodes[i] = parent
+    tree = ts.Tree()
+    tree.root = nodes[0]
+    return tree
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='number of leaves')
+    parser.add_argument('-g', type=int, default=10000, help='number of duplicate groups')
+    parser.add_argument('-d', type=int, default=3, help='number of duplicates per group')
+    args = parser.parse_args()
+
+    treestr = str(random_tree(args.n, 0)) + '\n'
+    reps = random.Random(1).sample(range(args.n), min(args.g, args.n))
+    dups = [['L%d' % r] + ['D%d_%d' % (r, j) for j in range(args.d)] for r in reps]
+
+    timings = dict()
+    outputs = dict()
+    for name, func in [('legacy', expand_dedupe_newick_legacy), ('single-pass', expand_dedupe_newick)]:
+        start = time.perf_counter()
+        outputs[name] = func(treestr, dups)
+        timings[name] = time.perf_counter() - start
+    print('leaves: %d, groups: %d, duplicates per group: %d' % (args.n, len(dups), args.d))
+    for name, seconds in timings.items():
+        print('%s: %.2f s' % (name, seconds))
+    print('same output: %s' % (outputs['legacy'] == outputs['single-pass']))
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# Benchmark of the whole-file FASTA parser against the original line-by-line readfq implementation.
+# usage: python scripts/bench_fasta2dic.py [-p] [-m] [-r REPEATS] alignment.fasta [alignment2.fasta ...]
+import argparse
+import sys
+import time
+from os.path import abspath, dirname
+
+import numpy as np
+
+# the uDance package is in the repository root, one level above this script
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from uDance.fasta2dic import fasta2dic, readfq
+
+
+def fasta2dic_readfq(ref_fp, prot_flag, mask_flag):
+    refs = {}
+    with open(ref_fp) as f:
+        mask_translation = str.maketrans('abcdefghijklmnopqrstuvwxyz', '-' * 26)
+
+        if prot_flag:
+            invalid_translation = str.maketrans('BJOUXZ', '-' * 6)
+        else:
+            invalid_translation = str.maketrans('BDEFHIJKLMNOPQRSUVWXYZ', '-' * 22)
+
+        def makeupper(s):
+            if mask_flag:
+                return s.translate(mask_translation)
+            else:
+                return s.upper()
+
+        for name, seq, qual in readfq(f):
+            refs[name] = np.frombuffer(makeupper(seq).translate(invalid_translation).encode(), dtype='S1')
+    return refs
+
+
+def best_of(func, repeats, *args):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        res = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark fasta2dic against the readfq based implementation')
+    parser.add_argument('alignments', nargs='+')
+    parser.add_argument('-p', '--protein', action='store_true', default=False)
+    parser.add_argument('-m', '--mask', action='store_true', default=False)
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    tot_old, tot_new = 0, 0
+    for aln in args.alignments:
+        t_old, old = best_of(fasta2dic_readfq, args.repeats, aln, args.protein, args.mask)
+        t_new, new = best_of(fasta2dic, args.repeats, aln, args.protein, args.mask)
+        assert list(old.keys()) == list(new.keys()), 'taxon names differ for %s' % aln
+        assert all(np.array_equal(old[k], new[k]) for k in old), 'sequences differ for %s' % aln
+        tot_old += t_old
+        tot_new += t_new
+        print('%s\treadfq %.4fs\tbulk %.4fs\tspeedup %.1fx' % (aln, t_old, t_new, t_old / t_new))
+    print('total\treadfq %.4fs\tbulk %.4fs\tspeedup %.1fx' % (tot_old, tot_new, tot_old / tot_new))
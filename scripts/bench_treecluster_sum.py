@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# Benchmark of the array-based min_tree_coloring_sum_max against the original node-based implementation
+# (which repaints subtrees with a DFS every time a cluster is closed), on a random binary tree.
+# usage: python scripts/bench_treecluster_sum.py [-n LEAVES] [-t THRESHOLD] [-e EDGE_THRESHOLD]
+import argparse
+import random
+import sys
+import time
+from collections import deque
+from os.path import abspath, dirname
+
+import treeswift as ts
+
+# the uDance package is in the repository root, one level above this script
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from uDance.treecluster_sum import ZERO_LEN, min_tree_coloring_sum_max
+
+
+def prep_legacy(tree, support):
+    tree.resolve_polytomies()
+    tree.suppress_unifurcations()
+    for node in tree.traverse_postorder():
+        node.color = -1
+        if not hasattr(node, 'placements'):
+            node.placements = []
+            node.resolved_randomly = True
+        else:
+            node.resolved_randomly = False
+        if not node.is_leaf():
+            try:
+                node.confidence = float(str(node))
+            except:
+                node.confidence = 100.0
+            if node.confidence < support:
+                node.edge_length = float('inf')
+
+
+def paint_legacy(node, color):
+    s = deque()
+    s.append(node)
+    while len(s) != 0:
+        n = s.pop()
+        if n.color < 0:
+            n.color = color
+            s.extend(n.children)
+
+
+def min_tree_coloring_sum_max_legacy(tree, thr, max_thr):
+    prep_legacy(tree, 0)
+    color = 0
+    for current in tree.traverse_postorder():
+        if current == tree.root:
+            current.weight = float('inf')
+        else:
+            current.weight = len(current.placements)
+        if current.is_leaf():
+            current.weight += 1
+            current.farthest = 0
+        else:
+            left, right = current.children
+            if (
+                left.weight + right.weight + current.weight <= thr
+                or (
+                    left.weight + right.weight + current.weight > thr and left.weight + right.weight <= max(3, thr / 10)
+                )
+                or left.edge_length + left.farthest + right.edge_length + right.farthest < max_thr
+                or (left.edge_length <= ZERO_LEN and len(left.placements) > 0)
+                or (right.edge_length <= ZERO_LEN and len(right.placements) > 0)
+                or (not current.is_root() and current.edge_length <= ZERO_LEN and len(current.placements) > 0)
+            ):
+                current.weight += left.weight + right.weight
+                current.farthest = max(left.edge_length + left.farthest, right.edge_length + right.farthest)
+            elif left.weight + right.weight <= thr:
+                paint_legacy(left, color)
+                paint_legacy(right, color)
+                color += 1
+                current.farthest = 0
+            else:
+                heavier, lighter = (left, right) if left.weight > right.weight else (right, left)
+                paint_legacy(heavier, color)
+                color += 1
+                current.farthest = lighter.farthest + lighter.edge_length
+                if lighter.weight + current.weight <= thr:
+                    current.weight += lighter.weight
+                else:
+                    paint_legacy(lighter, color)
+                    color += 1
+                    current.farthest = 0
+
+
+def random_tree(num_leaves, seed):
+    rng = random.Random(seed)
+    nodes = [ts.Node(label='L%d' % i, edge_length=rng.random() / 10) for i in range(num_leaves)]
+    while len(nodes) > 1:
+        i = rng.randrange(len(nodes) - 1)
+        parent = ts.Node(edge_length=rng.random() / 10)
+        parent.add_child(nodes[i])
+        parent.add_child(nodes.pop())
+        nodes[i] = parent
+    tree = ts.Tree()
+    tree.root = nodes[0]
+    for node in tree.traverse_postorder():
+        node.placements = [None] * max(0, rng.randint(-6, 3))
+    return tree
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1000000, help='number of leaves')
+    parser.add_argument('-t', type=float, default=1000, help='coloring threshold')
+    parser.add_argument('-e', type=float, default=0.02, help='edge (diameter) threshold')
+    args = parser.parse_args()
+
+    timings = dict()
+    colors = dict()
+    for name, func in [('legacy', min_tree_coloring_sum_max_legacy), ('arrays', min_tree_coloring_sum_max)]:
+        tree = random_tree(args.n, 0)
+        start = time.perf_counter()
+        func(tree, args.t, args.e)
+        timings[name] = time.perf_counter() - start
+        colors[name] = [node.color for node in tree.traverse_postorder()]
+    print('leaves: %d, colors: %d' % (args.n, len(set(colors['arrays']))))
+    for name, seconds in timings.items():
+        print('%s: %.2f s' % (name, seconds))
+    print('same coloring: %s' % (colors['legacy'] == colors['arrays']))
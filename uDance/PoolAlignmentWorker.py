@@ -4,72 +4,97 @@ from pathlib import Path
 
 import numpy as np
 
+from uDance.alignment_store import AlignmentStore, open_alignment, store_prefix
+
+GAP = ord('-')
+
 
 class PoolAlignmentWorker:
     subalignment_length = None
     fragment_length = None
-    fa_dict = None
-    basename = None
+    protein_flag = None
+    species_path_list = None
+    species_list = None
+    store_dir = None
+    store = None
 
+    # called once in every pool process (pool initializer), so it works under fork, spawn and forkserver alike
     @classmethod
-    def set_class_attributes(cls, subalignment_length, fragment_length, fa_dict, basename):
+    def set_class_attributes(
+        cls, subalignment_length, fragment_length, protein_flag, species_path_list, store_dir=None
+    ):
         cls.subalignment_length = subalignment_length
         cls.fragment_length = fragment_length
-        cls.fa_dict = fa_dict
-        cls.basename = basename
+        cls.protein_flag = protein_flag
+        cls.species_path_list = species_path_list
+        cls.species_list = []
+        for sp_path in species_path_list:
+            with open(sp_path) as file:
+                cls.species_list.append(set([line.rstrip() for line in file.readlines()]))
+        cls.store_dir = store_dir
+        cls.store = None
+
+    @classmethod
+    def prepare(cls, aln_input_file):
+        """convert the alignment to the binary store (if needed) and return the prefix of the store"""
+        open_alignment(aln_input_file, cls.protein_flag, False, cls.store_dir)
+        return store_prefix(aln_input_file, cls.protein_flag, False, cls.store_dir)
+
+    @classmethod
+    def _open_store(cls, prefix):
+        # consecutive tasks of a process usually belong to the same gene; keep its store open
+        if cls.store is None or cls.store.prefix != prefix:
+            cls.store = AlignmentStore(prefix)
+        return cls.store
 
     #  TODO raise error if directory exists
     @classmethod
-    def worker(cls, sp_path):
-        with open(sp_path) as file:
-            species = file.readlines()
-            species = set([line.rstrip() for line in species])
-        partition_aln = {key: cls.fa_dict[key] for key in species if key in cls.fa_dict}
+    def worker(cls, prefix, basename, sp_index):
+        store = cls._open_store(prefix)
+        sp_path = cls.species_path_list[sp_index]
+        names = sorted([key for key in cls.species_list[sp_index] if key in store])
         partition_output_dir = os.path.dirname(sp_path)
-        if len(partition_aln) < 4:
+        if len(names) < 4:
             return None
-        aln_length = len(next(iter(partition_aln.values())))
-        not_all_gap = np.array([False] * aln_length)
-        for s in partition_aln.values():
-            not_all_gap = np.logical_or(not_all_gap, (s != b'-'))
-        removelist = []
-        for k, v in partition_aln.items():
-            ungapped = v[not_all_gap]
-            if sum(ungapped != b'-') >= 75:
-                partition_aln[k] = ungapped
-            else:
-                removelist.append(k)
+        # gather the partition rows into a matrix
+        partition_aln = store.matrix[np.array([store.name_to_row[n] for n in names], dtype=np.int64)]
+        nongap = partition_aln != GAP
+        # remove all-gap columns, then fragmentary sequences
+        not_all_gap = nongap.any(axis=0)
+        partition_aln = partition_aln[:, not_all_gap]
+        not_fragment = nongap[:, not_all_gap].sum(axis=1) >= cls.fragment_length
         print(
             '%d fragmentary sequences are removed from gene %s on partition %s.'
-            % (len(removelist), cls.basename, partition_output_dir)
+            % (len(names) - np.count_nonzero(not_fragment), basename, partition_output_dir)
         )
-        for k in removelist:
-            partition_aln.pop(k)
+        partition_aln = np.ascontiguousarray(partition_aln[not_fragment])
+        names = [n for n, keep in zip(names, not_fragment) if keep]
 
-        trimmed_aln_length = len(next(iter(partition_aln.values())))
-
-        # deduplicate the alignment
-        seq_keyed_dict = {}
-        for name, sba in partition_aln.items():
-            seq = sba.tostring().decode('UTF-8')
-            if seq in seq_keyed_dict:
-                seq_keyed_dict[seq].append(name)
-            else:
-                seq_keyed_dict[seq] = [name]
+        trimmed_aln_length = partition_aln.shape[1]
+        if trimmed_aln_length < cls.subalignment_length or len(names) < 4:
+            return None
 
-        seq_keyed_dict = {k: sorted(v) for k, v in seq_keyed_dict.items()}
+        # deduplicate the alignment: identical rows are found by sorting the rows as opaque byte strings.
+        # the unique sequences come out in lexicographic order, like the sorted sequence strings
+        rows = partition_aln.view(np.dtype((np.void, trimmed_aln_length))).ravel()
+        unique_rows, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        # names are sorted, a stable sort keeps them sorted within each group of identical sequences
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique_rows) + 1))
 
-        if trimmed_aln_length >= cls.subalignment_length and len(seq_keyed_dict) >= 4:
+        if len(unique_rows) >= 4:
             # write trimmed MSA fasta
             res = []
             duplist = []
-            for k, v in sorted(seq_keyed_dict.items()):
+            for k in range(len(unique_rows)):
+                v = [names[m] for m in order[bounds[k] : bounds[k + 1]]]
                 res.append('>' + v[0])
-                res.append(k)
+                res.append(partition_aln[first[k]].tobytes().decode('UTF-8'))
                 if len(v) > 1:
                     duplist.append('\t'.join(v))
 
-            aln_outdir = join(partition_output_dir, cls.basename)
+            aln_outdir = join(partition_output_dir, basename)
             Path(aln_outdir).mkdir(parents=True, exist_ok=True)
             aln_output_path = join(aln_outdir, 'aln.fa')
             with open(aln_output_path, 'w', buffering=100000000) as f:
@@ -215,4 +240,5 @@ class PoolAlignmentWorker:
             # st = os.stat(script)
             # os.chmod(script, st.st_mode | stat.S_IEXEC)
             # return trimmed_aln_length*len(partition_aln), script
+            return len(unique_rows), trimmed_aln_length, aln_output_path
         return None
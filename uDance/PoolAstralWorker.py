@@ -3,12 +3,12 @@ from glob import glob
 from pathlib import Path
 from sys import stderr, exit, stdout
 import shutil
-from subprocess import Popen, PIPE
+from subprocess import Popen, DEVNULL
 import treeswift as ts
 from statistics import median
 from kmeans1d import cluster
 
-from uDance.expand_dedupe_newick import expand_dedupe_newick
+from uDance.expand_dedupe_newick import expand_dedupe_tree, read_dupmap
 
 
 class PoolAstralWorker:
@@ -66,13 +66,10 @@ class PoolAstralWorker:
                 median_map[gene] = median(lpps)
             # contract after computing the median
             tf.contract_low_support(threshold=cls.options.contract_threshold)
-            treestr = str(tf) + '\n'
             dupmap_file = Path(join(gene, 'dupmap.txt'))
             if dupmap_file.is_file():
-                dmp = list(map(lambda x: x.strip().split('\t'), open(dupmap_file).readlines()))
-                genetrees[gene] = expand_dedupe_newick(treestr, dmp)
-            else:
-                genetrees[gene] = treestr
+                expand_dedupe_tree(tf, read_dupmap(dupmap_file))
+            genetrees[gene] = tf
 
         # remove outlier genes. outlier is defined as having lower median local posterior probability than majority
         # we use 1d k-means (k=2) for outlier detection.
@@ -87,13 +84,9 @@ class PoolAstralWorker:
                 '%.2f median lpp are discarded.' % (partition_output_dir, numdiscard, min_median),
                 file=stderr,
             )
-            confident_trees = {
-                gene: ts.read_tree_newick(genetrees[gene])
-                for i, gene in enumerate(median_map.keys())
-                if clusters[i] == 1
-            }
+            confident_trees = {gene: genetrees[gene] for i, gene in enumerate(median_map.keys()) if clusters[i] == 1}
         else:
-            confident_trees = {gene: ts.read_tree_newick(tstr) for gene, tstr in genetrees.items()}
+            confident_trees = genetrees
         # remove low occupancy sequences from all gene trees
         occups = dict()
         for gn, t in confident_trees.items():
@@ -113,63 +106,52 @@ class PoolAstralWorker:
             print('In cluster %s, following low occupancy sequences are removed.' % partition_output_dir, file=stderr)
             print(low_occups, file=stderr)
 
-        tobepopped = []
-        for gene in confident_trees.keys():
-            nolowtree = confident_trees[gene].extract_tree_without(low_occups)
-            nolowtree.suppress_unifurcations()
-            nolowtree.is_rooted = False
-            confident_trees[gene] = nolowtree
-            if len(list(confident_trees[gene].labels())) < 4:
-                tobepopped.append(gene)
-        for g in tobepopped:
-            confident_trees.pop(g)
-
-        expanded_trees = []
-        for gene in confident_trees.keys():
-            extreepath = join(gene, 'raxml.expanded.nwk')
-            expanded_trees.append(extreepath)
-            with open(extreepath, 'w') as out:
-                out.write(str(confident_trees[gene]) + '\n')
+        # gene trees are written to the ASTRAL input as they are cleaned up
         astral_input_file = join(partition_output_dir, 'astral_input.trees')
-
-        with open(astral_input_file, 'wb') as wfd:
-            for f in expanded_trees:
-                with open(f, 'rb') as fd:
-                    shutil.copyfileobj(fd, wfd)
+        with open(astral_input_file, 'w') as out:
+            for gene, tree in confident_trees.items():
+                if len(low_occups) > 0:
+                    tree = tree.extract_tree_without(low_occups)
+                else:
+                    tree.suppress_unifurcations()
+                tree.is_rooted = False
+                if len(list(tree.labels())) < 4:
+                    continue
+                out.write(str(tree) + '\n')
 
         astral_output_file, astral_log_file, astral_const_file = [dict(), dict(), dict()]
         astral_const_file['incremental'] = join(partition_output_dir, 'astral_constraint.nwk')
         astral_const_file['updates'] = join(partition_output_dir, 'raxml_constraint.nwk')
-
         for mtd in ['incremental', 'updates']:
             astral_output_file[mtd] = Path(join(partition_output_dir, 'astral_output.%s.nwk' % mtd))
-            if (
-                mtd == 'updates'
-                and not Path(astral_const_file['updates']).is_file()
-                and not Path(astral_const_file['incremental']).is_file()
-            ):
-                shutil.copyfile(astral_output_file['incremental'], astral_output_file['updates'])
-                break
             astral_log_file[mtd] = join(partition_output_dir, 'astral.%s.log' % mtd)
-            if not Path(astral_const_file[mtd]).is_file():
-                s = [
-                    'java',
-                    '-Xmx%sM' % cls.options.memory,
-                    '-Djava.library.path=%s' % cls.astral_libdir,
-                    '-jar',
-                    cls.astral_mp_exec,
-                    '-i',
-                    astral_input_file,
-                    '-o',
-                    astral_output_file[mtd],
-                    '-C',
-                    '-T',
-                    str(cls.options.num_thread),
-                ]
-            else:
+
+        if not Path(astral_const_file['updates']).is_file() and not Path(astral_const_file['incremental']).is_file():
+            # both runs would be unconstrained, the updates output is a copy of the incremental one
+            runs = ['incremental']
+        else:
+            runs = ['incremental', 'updates']
+        # the two runs are independent. they run at the same time, sharing the threads and the memory, unless the
+        # split gives all of them to the incremental run.
+        split = cls.options.astral_split
+        if len(runs) == 2 and 0 < split < 1 and cls.options.num_thread > 1:
+            threads = min(max(1, round(cls.options.num_thread * split)), cls.options.num_thread - 1)
+            memory = round(cls.options.memory * split)
+            resources = {
+                'incremental': (threads, memory),
+                'updates': (cls.options.num_thread - threads, cls.options.memory - memory),
+            }
+            batches = [runs]
+        else:
+            resources = {mtd: (cls.options.num_thread, cls.options.memory) for mtd in runs}
+            batches = [[mtd] for mtd in runs]
+
+        for batch in batches:
+            processes = dict()
+            for mtd in batch:
                 s = [
                     'java',
-                    '-Xmx%sM' % cls.options.memory,
+                    '-Xmx%sM' % resources[mtd][1],
                     '-Djava.library.path=%s' % cls.astral_libdir,
                     '-jar',
                     cls.astral_mp_exec,
@@ -177,26 +159,24 @@ class PoolAstralWorker:
                     astral_input_file,
                     '-o',
                     astral_output_file[mtd],
-                    '-j',
-                    astral_const_file[mtd],
-                    '-C',
-                    '-T',
-                    str(cls.options.num_thread),
                 ]
-
-            with open(astral_log_file[mtd], 'w') as lg:
-                with Popen(s, stdout=PIPE, stdin=PIPE, stderr=lg) as p:
-                    astral_stdout = p.stdout.read().decode('utf-8')
-                    p.poll()
-                    if p.returncode:
-                        print(
-                            'ASTRAL job on partition %s has failed. Check the log file %s for further information.'
-                            % (partition_output_dir, astral_log_file[mtd]),
-                            file=stderr,
-                            flush=True,
-                        )
-                        exit(p.returncode)
-                    # print(astral_stdout)
+                if Path(astral_const_file[mtd]).is_file():
+                    s += ['-j', astral_const_file[mtd]]
+                s += ['-C', '-T', str(resources[mtd][0])]
+                with open(astral_log_file[mtd], 'w') as lg:
+                    processes[mtd] = Popen(s, stdout=DEVNULL, stdin=DEVNULL, stderr=lg)
+            failed = [mtd for mtd in batch if processes[mtd].wait()]
+            for mtd in failed:
+                print(
+                    'ASTRAL job on partition %s has failed. Check the log file %s for further information.'
+                    % (partition_output_dir, astral_log_file[mtd]),
+                    file=stderr,
+                    flush=True,
+                )
+            if failed:
+                exit(processes[failed[0]].returncode)
+        if runs == ['incremental']:
+            shutil.copyfile(astral_output_file['incremental'], astral_output_file['updates'])
         # if cls.options.use_gpu:
         #     gpu_opt = ""
         # else:
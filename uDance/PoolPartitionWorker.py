@@ -9,10 +9,12 @@ from uDance.compute_bipartition_alignment import compute_bipartition_alignment
 
 class PoolPartitionWorker:
     options = None
+    query_names = None
 
     @classmethod
-    def set_class_attributes(cls, options):
+    def set_class_attributes(cls, options, query_names):
         cls.options = options
+        cls.query_names = query_names
 
     @staticmethod
     def _undo_resolve_polytomies(tree):
@@ -26,7 +28,7 @@ class PoolPartitionWorker:
                     par.add_child(c)
 
     @classmethod
-    def worker(cls, i, j):
+    def worker(cls, i, j, outgroups_in_partition):
         partition_output_dir = join(cls.options.output_fp, str(i))
         Path(partition_output_dir).mkdir(parents=True, exist_ok=True)
         try:
@@ -39,11 +41,6 @@ class PoolPartitionWorker:
         with open(newick_path, 'a') as a_file:
             a_file.write('\n')
 
-        # find all outgroups
-        with open(join(cls.options.output_fp, 'all_outgroups.txt')) as file:
-            lines = file.readlines()
-            outgroups_all = set([line.rstrip() for line in lines])
-        outgroups_in_partition = [n.label for n in j.traverse_postorder() if n.label in outgroups_all]
         if len(outgroups_in_partition) >= 4:
             constraint = j.extract_tree_with(outgroups_in_partition, suppress_unifurcations=True)
             constraint.is_rooted = False
@@ -71,8 +68,8 @@ class PoolPartitionWorker:
                     if hasattr(n, 'placements'):
                         for p in n.placements:
                             pcount += 1
-                            species_list += [p]
-                            f.write(p + '\n')
+                            species_list += [cls.query_names[p]]
+                            f.write(cls.query_names[p] + '\n')
         if pcount <= cls.options.min_placements:
             print(
                 'Number of placements on the partition %s is less than or equal to %d. '
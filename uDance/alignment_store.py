@@ -0,0 +1,121 @@
+import json
+import os
+from os.path import basename, dirname, isfile, join, splitext
+from pathlib import Path
+
+import numpy as np
+
+from uDance.fasta2dic import read_fasta_matrix
+
+# alignments are converted once into <store_dir>/<gene>.<chartype>.bin (a raw uint8 character matrix)
+# and <store_dir>/<gene>.<chartype>.json (taxon names, row offsets and the fingerprint of the source file).
+# the store directory is set with --store-dir; by default it is STORE_DIRNAME in the output directory
+# (decompose) or in the working directory (mainlines), never in the alignment directory.
+STORE_DIRNAME = '.udance_store'
+STORE_VERSION = 1
+
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def default_store_dir(output_dir=None):
+    return join(output_dir if output_dir is not None else os.getcwd(), STORE_DIRNAME)
+
+
+def store_prefix(aln_path, prot_flag, mask_flag, store_dir=None):
+    if store_dir is None:
+        store_dir = default_store_dir()
+    chartype = 'prot' if prot_flag else 'nuc'
+    if mask_flag:
+        chartype += '.mask'
+    return join(store_dir, '%s.%s' % (splitext(basename(aln_path))[0], chartype))
+
+
+class AlignmentStore:
+    """Read-only view of a converted alignment.
+
+    ``matrix`` is a ``numpy.memmap`` of shape (number of taxa, alignment length). Rows are shared
+    through the page cache, so every process opening the same store uses the same physical memory.
+    """
+
+    def __init__(self, prefix):
+        with open(prefix + '.json') as f:
+            header = json.load(f)
+        self.prefix = prefix
+        self.names = header['names']
+        self.offsets = np.asarray(header['offsets'], dtype=np.int64)
+        self.length = header['length']
+        self.name_to_row = {name: i for i, name in enumerate(self.names)}
+        if self.names and self.length:
+            self.matrix = np.memmap(prefix + '.bin', dtype=np.uint8, mode='r', shape=(len(self.names), self.length))
+        else:
+            # mmap cannot map an empty file
+            self.matrix = np.zeros((len(self.names), self.length), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name_to_row
+
+    def row(self, name):
+        """zero-copy S1 view of the sequence of ``name``"""
+        return self.matrix[self.name_to_row[name]].view('S1')
+
+    def as_dict(self):
+        """fasta2dic compatible dictionary whose values are zero-copy views into the store"""
+        mat = self.matrix.view('S1')
+        return {name: mat[i] for i, name in enumerate(self.names)}
+
+
+def _is_fresh(prefix, aln_path):
+    if not (isfile(prefix + '.json') and isfile(prefix + '.bin')):
+        return False
+    try:
+        with open(prefix + '.json') as f:
+            header = json.load(f)
+    except ValueError:
+        return False
+    return header.get('version') == STORE_VERSION and header.get('source') == file_fingerprint(aln_path)
+
+
+def build_alignment_store(aln_path, prefix, prot_flag, mask_flag):
+    fingerprint = file_fingerprint(aln_path)
+    names, matrix = read_fasta_matrix(aln_path, prot_flag, mask_flag)
+    if len(set(names)) != len(names):
+        # same semantics as fasta2dic: the first occurrence fixes the order, the last one the sequence
+        rows = {name: i for i, name in enumerate(names)}
+        names = list(rows.keys())
+        matrix = matrix[list(rows.values())]
+    length = matrix.shape[1]
+
+    Path(dirname(prefix)).mkdir(parents=True, exist_ok=True)
+    # write to temporary files and rename, so that concurrent readers never see a partial store
+    tmp_suffix = '.%d.tmp' % os.getpid()
+    with open(prefix + '.bin' + tmp_suffix, 'wb') as f:
+        matrix.tofile(f)
+    header = {
+        'version': STORE_VERSION,
+        'source': fingerprint,
+        'length': length,
+        'names': names,
+        'offsets': [i * length for i in range(len(names))],
+    }
+    with open(prefix + '.json' + tmp_suffix, 'w') as f:
+        json.dump(header, f)
+    os.replace(prefix + '.bin' + tmp_suffix, prefix + '.bin')
+    os.replace(prefix + '.json' + tmp_suffix, prefix + '.json')
+
+
+def open_alignment(aln_path, prot_flag, mask_flag, store_dir=None):
+    """Open the binary store of ``aln_path``, converting the FASTA file first if the store is missing or stale."""
+    prefix = store_prefix(aln_path, prot_flag, mask_flag, store_dir)
+    if not _is_fresh(prefix, aln_path):
+        build_alignment_store(aln_path, prefix, prot_flag, mask_flag)
+    return AlignmentStore(prefix)
+
+
+def store_fasta2dic(aln_path, prot_flag, mask_flag, store_dir=None):
+    return open_alignment(aln_path, prot_flag, mask_flag, store_dir).as_dict()
@@ -0,0 +1,66 @@
+from math import log2
+
+# Rough relative cost model of the inference steps of uDance. Costs are in abstract units: they are meant
+# to compare and balance jobs against each other, not to predict wall-clock time.
+
+# relative speed of the gene tree inference methods (process_a_marker.sh) on the same alignment
+METHOD_FACTOR = {'raxml-8': 1.0, 'raxml-ng': 1.3, 'iqtree': 1.6, 'copy': 1.0}
+# likelihood computations scale with the square of the number of character states
+PROTEIN_FACTOR = (20 / 4) ** 2
+
+
+def gene_tree_cost(ntaxa, nsites, protein, method):
+    """
+    Estimated cost of inferring one gene tree. A likelihood evaluation is linear in the number of sites and taxa,
+    and the number of SPR rounds needed by the tree search grows roughly with log(number of taxa).
+    """
+    if ntaxa < 4:
+        return 0.0
+    cost = nsites * ntaxa * log2(ntaxa) * METHOD_FACTOR.get(method, 1.0)
+    if protein:
+        cost *= PROTEIN_FACTOR
+    return cost
+
+
+# ASTRAL (refine) is run twice per partition, for the incremental and the updates trees. Its running time grows
+# roughly with the square of the number of taxa and linearly with the number of genes. The factor puts it on the
+# scale of gene_tree_cost: on a partition of a few hundred taxa, the two ASTRAL runs take a fraction of the
+# time of inferring the gene trees.
+ASTRAL_RUNS = 2
+ASTRAL_FACTOR = 3.0
+
+
+def astral_cost(ntaxa, ngenes):
+    """Estimated cost of one ASTRAL run on ``ngenes`` gene trees of ``ntaxa`` taxa."""
+    return ASTRAL_FACTOR * ngenes * ntaxa**2
+
+
+def partition_cost(ntaxa, gene_lengths, gene_fractions, protein, method):
+    """
+    Estimated cost of a partition of ``ntaxa`` taxa (backbone taxa and queries). Gene ``i`` has alignment length
+    ``gene_lengths[i]`` and is present in the fraction ``gene_fractions[i]`` of the taxa.
+    Returns the costs of the gene trees and of the ASTRAL runs.
+    """
+    genes = sum(gene_tree_cost(ntaxa * f, length, protein, method) for length, f in zip(gene_lengths, gene_fractions))
+    return genes, ASTRAL_RUNS * astral_cost(ntaxa, len(gene_lengths))
+
+
+def partition_size(budget, gene_lengths, gene_fractions, protein, method):
+    """
+    Number of taxa of a partition whose estimated cost (see partition_cost) is the given budget.
+    The cost is increasing in the number of taxa, so the model is inverted by bisection.
+    """
+
+    def cost(ntaxa):
+        return sum(partition_cost(ntaxa, gene_lengths, gene_fractions, protein, method))
+
+    lo, hi = 1.0, 2.0
+    while cost(hi) < budget and hi < 1e12:
+        lo, hi = hi, hi * 2
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if cost(mid) < budget:
+            lo = mid
+        else:
+            hi = mid
+    return lo
@@ -1,21 +1,160 @@
-from uDance.fasta2dic import fasta2dic
+import json
+import multiprocessing as mp
+import os
 from os import listdir
-from os.path import isfile, join, splitext
-
-
-def count_occupancy(alndir, protein):
-    only_files = [f for f in listdir(alndir) if isfile(join(alndir, f)) and not f.startswith('.')]
-
-    num_genes = 0
-    occupancy = {}
-    for aln in only_files:
-        aln_input_file = join(alndir, aln)
-        basename = splitext(aln)[0]
-        fa_dict = fasta2dic(aln_input_file, protein, False)
-        num_genes += 1
-        for k in fa_dict.keys():
-            if k in occupancy:
-                occupancy[k] += 1
-            else:
-                occupancy[k] = 1
-    return occupancy, num_genes
+from os.path import isfile, join
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csc_matrix, load_npz, save_npz
+
+from uDance.alignment_store import default_store_dir, file_fingerprint
+
+OCCUPANCY_INDEX = 'occupancy'
+OCCUPANCY_INDEX_VERSION = 2
+SCAN_CHUNK_SIZE = 1 << 24
+
+
+def scan_fasta_names(aln_path):
+    """
+    Names of the records of a FASTA file. Only the header lines are decoded; sequence bytes are skipped
+    with bytes.find, chunk by chunk.
+    """
+    names = dict()
+    with open(aln_path, 'rb') as f:
+        buf = b'\n'
+        while True:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            buf += chunk
+            pos = buf.find(b'\n>')
+            while pos != -1:
+                end = buf.find(b'\n', pos + 2)
+                if end == -1:
+                    break
+                names[buf[pos + 2 : end].rstrip(b'\r').partition(b' ')[0].decode()] = None
+                pos = buf.find(b'\n>', end)
+            # keep a partial header, or the last byte to detect a header starting in the next chunk
+            buf = buf[pos:] if pos != -1 else buf[-1:]
+        if buf.startswith(b'\n>'):
+            names[buf[2:].rstrip(b'\r').partition(b' ')[0].decode()] = None
+    return list(names.keys())
+
+
+def first_record_length(aln_path):
+    """Length of the first sequence of a FASTA file, i.e. the alignment length of an aligned FASTA file."""
+    length = 0
+    in_record = False
+    with open(aln_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if in_record:
+                    break
+                in_record = True
+            elif in_record:
+                length += len(line.rstrip(b'\r\n'))
+    return length
+
+
+def scan_gene(aln_path):
+    return scan_fasta_names(aln_path), first_record_length(aln_path)
+
+
+def _index_paths(store_dir):
+    prefix = join(store_dir, OCCUPANCY_INDEX)
+    return prefix + '.npz', prefix + '.json'
+
+
+def _read_index(store_dir):
+    matrix_path, header_path = _index_paths(store_dir)
+    try:
+        with open(header_path) as f:
+            header = json.load(f)
+        if header.get('version') != OCCUPANCY_INDEX_VERSION:
+            return None
+        return load_npz(matrix_path).tocsc(), header
+    except (OSError, ValueError):
+        return None
+
+
+def load_occupancy_index(alndir, num_thread=1, store_dir=None):
+    """
+    Taxon-by-gene occupancy index of the alignments in ``alndir``.
+    Returns a sparse (number of taxa x number of genes) boolean matrix, the taxon names, the gene file names and
+    the alignment lengths of the genes.
+    The index is cached in the alignment store directory ``store_dir`` (see default_store_dir); a gene is rescanned
+    only if its file size or mtime changed.
+    """
+    if store_dir is None:
+        store_dir = default_store_dir()
+    only_files = sorted([f for f in listdir(alndir) if isfile(join(alndir, f)) and not f.startswith('.')])
+    fingerprints = {f: file_fingerprint(join(alndir, f)) for f in only_files}
+
+    # rows (as taxon names) and alignment length of every gene, either reused from the cached index or rescanned
+    rows_per_gene = dict()
+    length_per_gene = dict()
+    cached = _read_index(store_dir)
+    if cached is not None:
+        matrix, header = cached
+        if header['genes'] == only_files and header['sources'] == [fingerprints[f] for f in only_files]:
+            return matrix, header['taxa'], only_files, header['lengths']
+        cached_taxa = np.array(header['taxa'], dtype=object)
+        for j, (gene, fingerprint) in enumerate(zip(header['genes'], header['sources'])):
+            if fingerprints.get(gene) == fingerprint:
+                rows_per_gene[gene] = cached_taxa[matrix.indices[matrix.indptr[j] : matrix.indptr[j + 1]]]
+                length_per_gene[gene] = header['lengths'][j]
+
+    stale = [f for f in only_files if f not in rows_per_gene]
+    if num_thread > 1 and len(stale) > 1:
+        with mp.Pool(min(num_thread, len(stale))) as pool:
+            scanned = pool.map(scan_gene, [join(alndir, f) for f in stale])
+    else:
+        scanned = [scan_gene(join(alndir, f)) for f in stale]
+    for gene, (names, length) in zip(stale, scanned):
+        rows_per_gene[gene] = np.array(names, dtype=object)
+        length_per_gene[gene] = length
+
+    columns = [rows_per_gene[f] for f in only_files]
+    all_rows = np.concatenate(columns) if columns else np.zeros(0, dtype=object)
+    taxa, indices = np.unique(all_rows.astype(str), return_inverse=True)
+    indptr = np.zeros(len(only_files) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in columns], out=indptr[1:])
+    taxa = taxa.tolist()
+    lengths = [length_per_gene[f] for f in only_files]
+    matrix = csc_matrix(
+        (np.ones(len(indices), dtype=bool), indices.ravel().astype(np.int32), indptr),
+        shape=(len(taxa), len(only_files)),
+    )
+
+    matrix_path, header_path = _index_paths(store_dir)
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
+    tmp_suffix = '.%d.tmp' % os.getpid()
+    with open(matrix_path + tmp_suffix, 'wb') as f:
+        save_npz(f, matrix)
+    with open(header_path + tmp_suffix, 'w') as f:
+        json.dump(
+            {
+                'version': OCCUPANCY_INDEX_VERSION,
+                'genes': only_files,
+                'sources': [fingerprints[f] for f in only_files],
+                'taxa': taxa,
+                'lengths': lengths,
+            },
+            f,
+        )
+    os.replace(matrix_path + tmp_suffix, matrix_path)
+    os.replace(header_path + tmp_suffix, header_path)
+    return matrix, taxa, only_files, lengths
+
+
+def index_occupancy(index):
+    """number of genes of every taxon and number of genes of an index returned by load_occupancy_index"""
+    matrix, taxa, genes, _ = index
+    counts = np.asarray(matrix.sum(axis=1)).ravel()
+    occupancy = dict(zip(taxa, counts.tolist()))
+    return occupancy, len(genes)
+
+
+def count_occupancy(alndir, protein, num_thread=1, store_dir=None):
+    return index_occupancy(load_occupancy_index(alndir, num_thread, store_dir))
@@ -65,7 +65,7 @@ fi
 # $4 number of threads
 # $5 all alignments dir
 bash uDance/filter_backbone.sh $OUTDIR/placement/backbone.fa $OUTDIR/placement/backbone.tree \
-      $CHARTYPE $NUMTHREADS $ALNDIR $APF $APM $APB $APV $TDR 2> $OUTDIR/placement/filtering.log > $OUTDIR/placement/filtered.txt
+      $CHARTYPE $NUMTHREADS $ALNDIR $APF $APM $APB $APV $TDR $OUTDIR/alignment_store 2> $OUTDIR/placement/filtering.log > $OUTDIR/placement/filtered.txt
 
 # useless cat
 NUMFILT=`cat $OUTDIR/placement/filtered.txt | wc -l`
@@ -1,19 +1,21 @@
-import copy
-import glob
+import heapq
 import json
 import multiprocessing as mp
 import sys
+from collections import defaultdict, deque
 from os.path import join
 from pathlib import Path
-from random import Random
 
+import numpy as np
 import treeswift as ts
 
 from uDance.PoolPartitionWorker import PoolPartitionWorker
-from uDance.count_occupancy import count_occupancy
+from uDance.cost_model import gene_tree_cost, partition_cost, partition_size
+from uDance.count_occupancy import index_occupancy, load_occupancy_index
+from uDance.jplace import read_jplace
 from uDance.newick_extended import read_tree_newick
 from uDance.prep_partition_alignments import prep_partition_alignments
-from uDance.treecluster_sum import min_tree_coloring_sum_max
+from uDance.treecluster_sum import coloring_sum_max, min_tree_coloring_sum_max, tree_to_arrays
 
 
 # inputs: a placement tree
@@ -21,25 +23,105 @@ from uDance.treecluster_sum import min_tree_coloring_sum_max
 
 
 def aggregate_placements(index_to_node_map, placements):
-    for placement in placements:
-        for i, seqname in enumerate(placement['n']):
-            index = placement['p'][i][0]
-            index_to_node_map[index].placements += [seqname]
+    # node.placements is the array of the ids of the queries placed on the edge above the node
+    for index, node in index_to_node_map.items():
+        node.placements = placements.edge(index)
 
 
 def closest_merge(x, y):
     return x[0] + y, x[1]
 
 
+# A representative is stored compactly as a tiny nested list [label, edge_length, children]: the tree induced
+# on (at most three) representative leaves together with the connecting path lengths. _induce mirrors what
+# extract_tree_with(labels, suppress_unifurcations=True) does on the grafted trees (including the order in which
+# edge lengths are summed), without creating treeswift trees. Treeswift trees are only built, by
+# representative_tree, for the nodes that decompose actually uses.
+def _induce(edge_length, children, labs):
+    def prune(rep):
+        label, length, chd = rep
+        if not chd:
+            return [label, length, []] if label in labs else None
+        chd = [c for c in map(prune, chd) if c is not None]
+        return [label, length, chd] if chd else None
+
+    def suppress(root):
+        # same breadth-first walk as Tree.suppress_unifurcations: a suppressed node is replaced by its child,
+        # which is moved to the end of the children of its parent
+        parents = dict()
+        queue = deque([root])
+        while queue:
+            rep = queue.popleft()
+            if len(rep[2]) != 1:
+                for c in rep[2]:
+                    parents[id(c)] = rep
+                queue.extend(rep[2])
+                continue
+            child = rep[2].pop()
+            if rep is root:
+                root = child
+            else:
+                siblings = parents[id(rep)][2]
+                del siblings[next(i for i, c in enumerate(siblings) if c is rep)]
+                siblings.append(child)
+                parents[id(child)] = parents[id(rep)]
+            if rep[1] is not None:
+                child[1] = (0 if child[1] is None else child[1]) + rep[1]
+            queue.append(child)
+        return root
+
+    return suppress(prune([None, edge_length, children]))
+
+
+def representative_tree(node, direction):
+    rep = node.repr[direction]
+    if rep is None:
+        return None
+    tree = ts.Tree()
+    # only the (never extracted) representative of a leaf was unrooted
+    tree.is_rooted = not (direction == 'down' and node.is_leaf())
+    stack = [(tree.root, rep)]
+    tree.root.label, tree.root.edge_length = rep[0], rep[1]
+    while stack:
+        tsnode, (label, length, chd) = stack.pop()
+        if not chd:
+            tsnode.outgroup = True
+        for c in chd:
+            tschild = ts.Node(label=c[0], edge_length=c[1])
+            tsnode.add_child(tschild)
+            stack.append((tschild, c))
+    return tree
+
+
+def graft_representative(parent, node, direction, outgroups):
+    """
+    Add the representative tree of ``node`` in ``direction`` as a child of ``parent`` and record its leaves
+    in ``outgroups``. Returns the representative tree, or None if there is no representative.
+    """
+    rep = representative_tree(node, direction)
+    if rep is None:
+        return None
+    outgroups.update(leaf.label for leaf in rep.traverse_leaves())
+    parent.add_child(rep.root)
+    return rep
+
+
+def outgroup_tree(neighbours, outgroups):
+    """unrooted tree joining the representatives of the (node, direction) pairs in ``neighbours``"""
+    tree = ts.Tree()
+    tree.is_rooted = False
+    tree.root.outgroup = False
+    for node, direction in neighbours:
+        graft_representative(tree.root, node, direction, outgroups)
+    return tree
+
+
 def set_closest_three_directions(tree, occupancy_threshold):
     for node in tree.traverse_postorder():
-        node.repr_tree = {'down': ts.Tree(is_rooted=False)}
-        node.repr_tree['down'].root.edge_length = node.edge_length
         if node.is_leaf():
             # node.closest[0] is left. node.closest[1] is right. node.closest[2] is high occupancy
             node.repr_tuple = {'down': [(0, node), (0, node), (0, node)]}
-            node.repr_tree['down'].root.label = node.label
-            node.repr_tree['down'].root.outgroup = True
+            node.repr = {'down': [node.label, node.edge_length, []]}
         else:
             closests = [
                 min(map(lambda x: closest_merge(x, chd.edge_length), chd.repr_tuple['down'][:2]))
@@ -51,21 +133,14 @@ def set_closest_three_directions(tree, occupancy_threshold):
             else:
                 theoccup = [occups[0]]
             node.repr_tuple = {'down': closests + theoccup}
-            for chd in node.children:
-                chdcopy = chd.repr_tree['down'].__copy__()
-                node.repr_tree['down'].root.add_child(chdcopy.root)
-            labs = list(set([x[1].label for x in node.repr_tuple['down']]))
-            node.repr_tree['down'] = node.repr_tree['down'].extract_tree_with(labels=labs, suppress_unifurcations=True)
-            for e in node.repr_tree['down'].traverse_postorder(internal=False):
-                e.outgroup = True
+            labs = set([x[1].label for x in node.repr_tuple['down']])
+            node.repr = {'down': _induce(node.edge_length, [chd.repr['down'] for chd in node.children], labs)}
 
     for node in tree.traverse_preorder():
         if node == tree.root:
             node.repr_tuple['up'] = [(float('inf'), None), (float('inf'), None), (float('inf'), None)]
-            node.repr_tree['up'] = None
+            node.repr['up'] = None
         else:
-            node.repr_tree['up'] = ts.Tree(is_rooted=False)
-            node.repr_tree['up'].root.edge_length = node.edge_length
             sib = [chd for chd in node.parent.children if chd != node][0]  # assumes binary tree
             closests = [min(map(lambda x: closest_merge(x, node.edge_length), node.parent.repr_tuple['up'][:2]))]
             closests += [
@@ -83,16 +158,10 @@ def set_closest_three_directions(tree, occupancy_threshold):
                 theoccup = [occups[0]]
             node.repr_tuple['up'] = closests + theoccup
 
-            drecs = list(zip([node.parent, sib], ['up', 'down']))
-            for nei, drec in drecs:
-                if nei.repr_tree[drec] is not None:
-                    chdcopy = nei.repr_tree[drec].__copy__()
-                    node.repr_tree['up'].root.add_child(chdcopy.root)
+            neighbours = [nei.repr[drec] for nei, drec in [(node.parent, 'up'), (sib, 'down')]]
             valids = [pr for pr in node.repr_tuple['up'] if pr[1] is not None]
-            labs = list(set([x[1].label for x in valids]))
-            node.repr_tree['up'] = node.repr_tree['up'].extract_tree_with(labels=labs, suppress_unifurcations=True)
-            for e in node.repr_tree['up'].traverse_postorder(internal=False):
-                e.outgroup = True
+            labs = set([x[1].label for x in valids])
+            node.repr['up'] = _induce(node.edge_length, [r for r in neighbours if r is not None], labs)
 
 
 def build_color_spanning_tree(tstree):
@@ -118,17 +187,172 @@ def build_color_spanning_tree(tstree):
 
 
 def balance_jobs(lst, num_jobs):
-    def chunks(l, n):
-        """Yield n number of striped chunks from l."""
-        for i in range(0, n):
-            yield l[i::n]
+    """
+    Pack (cost, script) pairs into num_jobs groups using the longest-processing-time-first heuristic:
+    jobs are taken from the most to the least expensive and each one goes to the least loaded group.
+    Returns (predicted makespan, scripts) for each group.
+    """
+    loads = [(0.0, i) for i in range(num_jobs)]
+    groups = [[] for _ in range(num_jobs)]
+    for cost, script in sorted(lst, reverse=True):
+        load, i = heapq.heappop(loads)
+        groups[i].append(script)
+        heapq.heappush(loads, (load + cost, i))
+    makespans = dict((i, load) for load, i in loads)
+    return [(makespans[i], g) for i, g in enumerate(groups)]
+
+
+def occupancy_profile(index, tstree, placements):
+    """
+    Gene occupancy of the elements (backbone taxa and placed queries) according to the occupancy ``index`` (see
+    load_occupancy_index).
+    Returns the alignment lengths of the genes, the fraction of the elements present in each gene, the occupancy
+    matrix, the rows of the matrix of the leaves of ``tstree`` and of the queries (-1 if missing) and the number
+    of elements of every taxon of the matrix.
+    """
+    matrix, taxa, _, lengths = index
+    row = {taxon: i for i, taxon in enumerate(taxa)}
+    lengths = np.asarray(lengths, dtype=float)
+    # number of elements of every taxon of the occupancy index
+    multiplicity = np.zeros(len(taxa))
+    leaf_rows = np.array([row.get(leaf.label, -1) for leaf in tstree.traverse_leaves()], dtype=np.int64)
+    query_rows = np.array([row.get(name, -1) for name in placements.names], dtype=np.int64)
+    query_counts = np.bincount(placements.ids, minlength=len(placements.names))
+    np.add.at(multiplicity, leaf_rows[leaf_rows >= 0], 1)
+    np.add.at(multiplicity, query_rows[query_rows >= 0], query_counts[query_rows >= 0])
+    num_elements = len(leaf_rows) + len(placements)
+    gene_fractions = (matrix.T @ multiplicity) / num_elements
+    return lengths, gene_fractions, matrix, leaf_rows, query_rows, multiplicity
+
+
+def cost_weights(options, index, tstree, placements):
+    """
+    Threshold and node weights for colouring the tree by estimated cost (--budget) instead of by number of elements.
+    The budget is turned into a partition size by inverting the cost model, for elements (backbone taxa and
+    placed queries) of average gene occupancy and alignment length. The weight of an element is its share of the
+    ASTRAL cost, the same for all elements, plus its share of the gene tree cost, in proportion to the total length
+    of the genes it is present in; the average element weighs 1.
+    """
+    lengths, gene_fractions, matrix, leaf_rows, query_rows, multiplicity = occupancy_profile(index, tstree, placements)
+    num_elements = len(leaf_rows) + len(placements)
+    taxon_volume = matrix @ lengths
+    mean_volume = (multiplicity @ taxon_volume) / num_elements
+    threshold = partition_size(options.budget, lengths, gene_fractions, options.protein_seqs, options.method)
+    gene_cost, astral_cost = partition_cost(threshold, lengths, gene_fractions, options.protein_seqs, options.method)
+    gene_share = gene_cost / (gene_cost + astral_cost) if mean_volume > 0 else 0.0
+    print(
+        'Partition budget %g: about %d elements per partition, %.0f%% of the cost in gene trees'
+        % (options.budget, threshold, 100 * gene_share)
+    )
+
+    # the last entry is for the elements missing from the occupancy index (row -1), which are in no gene
+    taxon_volume = np.append(taxon_volume, 0)
+    taxon_weight = gene_share * taxon_volume / (mean_volume if mean_volume > 0 else 1) + 1 - gene_share
+    leaf_weight = {leaf.label: taxon_weight[r] for leaf, r in zip(tstree.traverse_leaves(), leaf_rows.tolist())}
+    query_weight = taxon_weight[query_rows]
+
+    def node_weight(node):
+        weight = leaf_weight[node.label] if node.is_leaf() else 0.0
+        if len(node.placements):
+            weight += query_weight[node.placements].sum()
+        return float(weight)
+
+    return threshold, node_weight
+
+
+def parse_values(text):
+    """numbers of a comma-separated list of values and start:stop:step ranges (the stop is included)"""
+    values = []
+    for part in str(text).split(','):
+        if ':' in part:
+            start, stop, step = map(float, part.split(':'))
+            values.extend(np.arange(start, stop + step / 2, step).tolist())
+        else:
+            values.append(float(part))
+    return values
+
+
+def representative_labels(node, direction):
+    """labels of the leaves of the representative of ``node`` in ``direction`` (see set_closest_three_directions)"""
+    return set(x[1].label for x in node.repr_tuple[direction] if x[1] is not None)
+
+
+def preview(options, tstree, placements):
+    """
+    Print the partitions that decompose would create for every combination of the values of --threshold and
+    --edge-threshold (see parse_values): their number, their sizes (backbone taxa and placed queries, without the
+    outgroups), the number of distinct outgroups and the estimated total and maximum cost (see cost_model.py)
+    of their inference. The tree is turned into arrays and its representatives are computed once, and the
+    occupancy index is loaded once. Only the index is read; if it is missing or stale (e.g. on the first run), it
+    is built from the headers of the alignments. No partition is written.
+    """
+    index = load_occupancy_index(options.alignment_dir_fp, options.num_thread, options.store_dir)
+    if options.budget is None:
+        thresholds = parse_values(options.threshold)
+        weight_of = None
+    else:
+        threshold, weight_of = cost_weights(options, index, tstree, placements)
+        thresholds = [threshold]
+    edge_thresholds = parse_values(options.edge_threshold)
+    nodes, parent, left, right, edge_length, num_placements, weight = tree_to_arrays(tstree, 0, weight_of)
+    elements = np.asarray(num_placements) + (np.asarray(left) < 0)
+    left, right = np.asarray(left), np.asarray(right)
+
+    occupancy, num_genes = index_occupancy(index)
+    for e in tstree.traverse_postorder(internal=False):
+        e.occupancy = occupancy.get(e.label, 0)
+    set_closest_three_directions(tstree, num_genes * options.occupancy_threshold)
+    lengths, gene_fractions = occupancy_profile(index, tstree, placements)[:2]
+    costs = dict()
 
-    r = Random(42)
-    # per = max(1, len(lst)//num_jobs)
-    r.shuffle(lst)
-    group = chunks(lst, num_jobs)
+    def cost(size):
+        if size not in costs:
+            costs[size] = sum(partition_cost(size, lengths, gene_fractions, options.protein_seqs, options.method))
+        return costs[size]
 
-    return [list(map(lambda x: x[1], sorted(g, reverse=True))) for g in group]
+    print(
+        '%10s %10s %10s %8s %8s %8s %10s %12s %12s'
+        % ('threshold', 'edge', 'partitions', 'min', 'median', 'max', 'outgroups', 'total cost', 'max cost')
+    )
+    for thr in thresholds:
+        for max_thr in edge_thresholds:
+            colors = coloring_sum_max(parent, left, right, edge_length, num_placements, weight, thr, max_thr)
+            # the same cases as in decompose: the outgroups of the partitions on each side of a colour boundary
+            outgroups = defaultdict(set)
+            internal = left >= 0
+            boundary = internal & (
+                (colors[np.where(internal, left, 0)] != colors) | (colors[np.where(internal, right, 0)] != colors)
+            )
+            for i in np.flatnonzero(boundary).tolist():
+                n, cl, cr = nodes[i], nodes[left[i]], nodes[right[i]]
+                c, a, b = colors[i], colors[left[i]], colors[right[i]]
+                if a != c:
+                    outgroups[c] |= representative_labels(cl, 'down')
+                if b != c:
+                    outgroups[c] |= representative_labels(cr, 'down')
+                if a != c and a != b:
+                    outgroups[a] |= representative_labels(cr, 'down') | representative_labels(n, 'up')
+                if b != c and a != b:
+                    outgroups[b] |= representative_labels(cl, 'down') | representative_labels(n, 'up')
+                if a != c and a == b:
+                    outgroups[a] |= representative_labels(n, 'up')
+            # colours are numbered from 0; -1 is the colour of the root, which is not a partition
+            sizes = np.bincount(colors[colors >= 0], weights=elements[colors >= 0]).astype(int)
+            partition_costs = [cost(int(size) + len(outgroups[c])) for c, size in enumerate(sizes)]
+            print(
+                '%10g %10g %10d %8d %8g %8d %10d %12.3g %12.3g'
+                % (
+                    thr,
+                    max_thr,
+                    len(sizes),
+                    sizes.min() if len(sizes) else 0,
+                    np.median(sizes) if len(sizes) else 0,
+                    sizes.max() if len(sizes) else 0,
+                    len(set().union(*outgroups.values())),
+                    sum(partition_costs),
+                    max(partition_costs, default=0),
+                )
+            )
 
 
 def decompose(options):
@@ -136,20 +360,27 @@ def decompose(options):
         sys.stderr.write('Invalid number of tasks. Number of tasks is set to the minimum value: 1.\n')
         options.num_tasks = 1
 
-    with open(options.jplace_fp) as f:
-        jp = json.load(f)
-    tstree = read_tree_newick(jp['tree'])
+    tree_string, placements = read_jplace(options.jplace_fp)
+    tstree = read_tree_newick(tree_string)
 
     index_to_node_map = {}
     for e in tstree.traverse_postorder():
-        e.placements = []
+        e.placements = placements.ids[:0]
         if e != tstree.root:
             index_to_node_map[e.edge_index] = e
-    aggregate_placements(index_to_node_map, jp['placements'])
+    aggregate_placements(index_to_node_map, placements)
+    if options.preview:
+        preview(options, tstree, placements)
+        return
 
+    index = load_occupancy_index(options.alignment_dir_fp, options.num_thread, options.store_dir)
     # min_tree_coloring_sum(tstree, float(options.threshold))
-    min_tree_coloring_sum_max(tstree, float(options.threshold), options.edge_threshold)
-    occupancy, num_genes = count_occupancy(options.alignment_dir_fp, options.protein_seqs)
+    if options.budget is None:
+        min_tree_coloring_sum_max(tstree, float(options.threshold), float(options.edge_threshold))
+    else:
+        threshold, node_weight = cost_weights(options, index, tstree, placements)
+        min_tree_coloring_sum_max(tstree, threshold, float(options.edge_threshold), node_weight)
+    occupancy, num_genes = index_occupancy(index)
 
     for e in tstree.traverse_postorder(internal=False):
         if e.label in occupancy:
@@ -177,6 +408,8 @@ def decompose(options):
     tree_catalog = {}
 
     outgroup_map = {-1: {'up': None, 'ownsup': False, 'children': dict()}}
+    # labels of every leaf written to the outgroup map, collected while the representatives are grafted
+    all_outgroups = set()
     for n, ncopy in traversal:
         ncopy.resolved_randomly = n.resolved_randomly
         ncopy.placements = n.placements
@@ -192,35 +425,19 @@ def decompose(options):
         #                   C3
         if cl.color != n.color and cr.color != n.color and cl.color != cr.color:
             ncopy.remove_child(clcopy)
-            outcl = copy.deepcopy(cl.repr_tree['down'])
+            outcl = graft_representative(ncopy, cl, 'down', all_outgroups)
             outgroup_map[n.color]['children'][cl.color] = outcl.newick()
-            ncopy.add_child(outcl.root)
 
             ncopy.remove_child(crcopy)
-            outcr = copy.deepcopy(cr.repr_tree['down'])
+            outcr = graft_representative(ncopy, cr, 'down', all_outgroups)
             outgroup_map[n.color]['children'][cr.color] = outcr.newick()
-            ncopy.add_child(outcr.root)
-
-            newTreeL = ts.Tree()
-            newTreeL.is_rooted = False
-            newTreeL.root.outgroup = False
-            outcr = copy.deepcopy(cr.repr_tree['down'])
-            newTreeL.root.add_child(outcr.root)
-            outup = copy.deepcopy(n.repr_tree['up'])
-            if outup:
-                newTreeL.root.add_child(outup.root)
+
+            newTreeL = outgroup_tree([(cr, 'down'), (n, 'up')], all_outgroups)
             outgroup_map[cl.color] = {'up': newTreeL.newick(), 'ownsup': True, 'children': dict()}
             newTreeL.root.add_child(clcopy)
             tree_catalog[cl.color] = newTreeL
 
-            newTreeR = ts.Tree()
-            newTreeR.is_rooted = False
-            newTreeR.root.outgroup = False
-            outcl = copy.deepcopy(cl.repr_tree['down'])
-            newTreeR.root.add_child(outcl.root)
-            outup = copy.deepcopy(n.repr_tree['up'])
-            if outup:
-                newTreeR.root.add_child(outup.root)
+            newTreeR = outgroup_tree([(cl, 'down'), (n, 'up')], all_outgroups)
             outgroup_map[cr.color] = {'up': newTreeR.newick(), 'ownsup': True, 'children': dict()}
             newTreeR.root.add_child(crcopy)
             tree_catalog[cr.color] = newTreeR
@@ -230,18 +447,10 @@ def decompose(options):
         #                   C3
         if cl.color != n.color and cr.color == n.color and cl.color != cr.color:
             ncopy.remove_child(clcopy)
-            outcl = copy.deepcopy(cl.repr_tree['down'])
+            outcl = graft_representative(ncopy, cl, 'down', all_outgroups)
             outgroup_map[n.color]['children'][cl.color] = outcl.newick()
-            ncopy.add_child(outcl.root)
-
-            newTreeL = ts.Tree()
-            newTreeL.is_rooted = False
-            newTreeL.root.outgroup = False
-            outcr = copy.deepcopy(cr.repr_tree['down'])
-            newTreeL.root.add_child(outcr.root)
-            outup = copy.deepcopy(n.repr_tree['up'])
-            if outup:
-                newTreeL.root.add_child(outup.root)
+
+            newTreeL = outgroup_tree([(cr, 'down'), (n, 'up')], all_outgroups)
             outgroup_map[cl.color] = {'up': newTreeL.newick(), 'ownsup': True, 'children': dict()}
             newTreeL.root.add_child(clcopy)
             tree_catalog[cl.color] = newTreeL
@@ -251,18 +460,10 @@ def decompose(options):
         #                   C1
         if cl.color == n.color and cr.color != n.color and cl.color != cr.color:
             ncopy.remove_child(crcopy)
-            outcr = copy.deepcopy(cr.repr_tree['down'])
+            outcr = graft_representative(ncopy, cr, 'down', all_outgroups)
             outgroup_map[n.color]['children'][cr.color] = outcr.newick()
-            ncopy.add_child(outcr.root)
-
-            newTreeR = ts.Tree()
-            newTreeR.is_rooted = False
-            newTreeR.root.outgroup = False
-            outcl = copy.deepcopy(cl.repr_tree['down'])
-            newTreeR.root.add_child(outcl.root)
-            outup = copy.deepcopy(n.repr_tree['up'])
-            if outup:
-                newTreeR.root.add_child(outup.root)
+
+            newTreeR = outgroup_tree([(cl, 'down'), (n, 'up')], all_outgroups)
             outgroup_map[cr.color] = {'up': newTreeR.newick(), 'ownsup': True, 'children': dict()}
             newTreeR.root.add_child(crcopy)
             tree_catalog[cr.color] = newTreeR
@@ -272,30 +473,17 @@ def decompose(options):
         #                   C3
         if cl.color != n.color and cr.color != n.color and cl.color == cr.color:
             ncopy.remove_child(clcopy)
-            outcl = copy.deepcopy(cl.repr_tree['down'])
-            ncopy.add_child(outcl.root)
-
+            graft_representative(ncopy, cl, 'down', all_outgroups)
             ncopy.remove_child(crcopy)
-            outcr = copy.deepcopy(cr.repr_tree['down'])
-            ncopy.add_child(outcr.root)
-
-            # special case for outgroup map
-            # create a throwaway tree to print its newick
-            newTreeR = ts.Tree()
-            newTreeR.is_rooted = False
-            newTreeR.root.outgroup = False
-            outcl = copy.deepcopy(cl.repr_tree['down'])
-            newTreeR.root.add_child(outcl.root)
-            outcr = copy.deepcopy(cr.repr_tree['down'])
-            newTreeR.root.add_child(outcr.root)
-            outgroup_map[n.color]['children'][cr.color] = newTreeR.newick()
-
-            newTree = ts.Tree()
-            newTree.is_rooted = False
-            newTree.root.outgroup = False
-            outup = copy.deepcopy(n.repr_tree['up'])
-            if outup:
-                newTree.root.add_child(outup.root)
+            graft_representative(ncopy, cr, 'down', all_outgroups)
+
+            # special case for outgroup map: a throwaway tree is created to print its newick
+            outgroup_map[n.color]['children'][cr.color] = outgroup_tree(
+                [(cl, 'down'), (cr, 'down')], all_outgroups
+            ).newick()
+
+            newTree = outgroup_tree([(n, 'up')], all_outgroups)
+            if newTree.root.children:
                 outgroup_map[cr.color] = {'up': newTree.newick(), 'ownsup': False, 'children': dict()}
             else:
                 outgroup_map[cr.color] = {'up': None, 'ownsup': False, 'children': dict()}
@@ -305,22 +493,19 @@ def decompose(options):
 
     with open(join(options.output_fp, 'outgroup_map.json'), 'w') as f:
         f.write(json.dumps(outgroup_map, sort_keys=True, indent=4))
-    all_outgroups = []
-    for n, dc in outgroup_map.items():
-        if dc['up']:
-            all_outgroups += [leaf.label for leaf in ts.read_tree_newick(dc['up']).traverse_postorder(internal=False)]
-        if dc['children']:
-            for nc, dcc in dc['children'].items():
-                all_outgroups += [leaf.label for leaf in ts.read_tree_newick(dcc).traverse_postorder(internal=False)]
-    all_outgroups = list(set(all_outgroups))
     with open(join(options.output_fp, 'all_outgroups.txt'), 'w') as f:
         f.write('\n'.join(all_outgroups) + '\n')
+    # the outgroups of a partition are its taxa that are outgroups of any partition
+    partition_outgroups = dict()
     for i, t in tree_catalog.items():
+        partition_outgroups[i] = []
         for e in t.traverse_postorder():
             if not (hasattr(e, 'outgroup') and e.outgroup is True):
                 e.outgroup = False
             if not (hasattr(e, 'resolved_randomly') and e.resolved_randomly is True):
                 e.resolved_randomly = False
+            if e.label in all_outgroups:
+                partition_outgroups[i].append(e.label)
     # stitching algorithm:
     # preorder traversal color_to_node_map
     # for each node n, find the joint j in tstree.
@@ -328,39 +513,48 @@ def decompose(options):
     # replace it with n.children
 
     partition_worker = PoolPartitionWorker()
-    partition_worker.set_class_attributes(options)
+    partition_worker.set_class_attributes(options, placements.names)
 
     pool = mp.Pool(options.num_thread)
-    species_path_list = pool.starmap(partition_worker.worker, tree_catalog.items())
+    species_path_list = pool.starmap(
+        partition_worker.worker, [(i, t, partition_outgroups[i]) for i, t in tree_catalog.items()]
+    )
     pool.close()
     pool.join()
 
-    all_scripts = prep_partition_alignments(
+    jobs = prep_partition_alignments(
         options.alignment_dir_fp,
         options.protein_seqs,
         [pth for pth, skip in species_path_list if not skip],
         options.num_thread,
         options.subalignment_length,
         options.fragment_length,
+        options.genes_in_flight,
+        options.store_dir,
     )
 
-    tasks = balance_jobs(all_scripts, options.num_tasks)
-    for i, t in enumerate(tasks):
+    chartype = 'prot' if options.protein_seqs else 'nuc'
+    scripts = [
+        (
+            gene_tree_cost(ntaxa, nsites, options.protein_seqs, options.method),
+            'bash uDance/process_a_marker.sh %s %s %d %s %d'
+            % (aln, chartype, options.num_starts, options.method, options.infer_threads),
+        )
+        for ntaxa, nsites, aln in jobs
+    ]
+    tasks = balance_jobs(scripts, options.num_tasks)
+    for i, (makespan, t) in enumerate(tasks):
+        print('Task file main_raxml_script_%d.sh: %d jobs, predicted makespan %.3g' % (i, len(t), makespan))
         main_script = open(join(options.output_fp, 'main_raxml_script_%s.sh' % str(i)), 'w')
+        main_script.write('# predicted makespan: %.3g\n' % makespan)
         main_script.write('\n'.join(t))
         main_script.write('\n')
         main_script.close()
 
-    indvalns = glob.glob(join(options.output_fp, '*/*/aln.fa'))
-
     with open(join(options.output_fp, 'jobsizes.txt'), 'w', buffering=10000000) as js:
-        for p in indvalns:
-            count = 0
-            for line in open(p).readlines():
-                if line.startswith('>'):
-                    count += 1
-            par, gene = p.split('/')[-3:-1]
-            js.write(par + '\t' + gene + '\t' + str(count) + '\n')
+        for ntaxa, nsites, aln in sorted(jobs, key=lambda x: x[2]):
+            par, gene = aln.split('/')[-3:-1]
+            js.write(par + '\t' + gene + '\t' + str(ntaxa) + '\n')
 
     # TODO a bipartition for each alignment
     for i, j in tree_catalog.items():
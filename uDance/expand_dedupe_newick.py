@@ -1,10 +1,58 @@
+import re
+
+from treeswift import Node
+
+# a leaf label: after an opening parenthesis or a comma and before its edge length
+LEAF_LABEL = re.compile(r'(?<=[(,])([^(),:;]+)(?=:)')
+
+
+def read_dupmap(dupmap_path):
+    """
+    Reads a dupmap.txt file: one line per group of identical sequences, with the name of the representative kept in
+    the alignment followed by the names of its duplicates, separated by tabs. Returns the list of groups.
+    """
+    with open(dupmap_path) as f:
+        return [line.strip().split('\t') for line in f]
+
+
 def expand_dedupe_newick(treestr, dups):
+    """
+    Inserts the duplicates of ``dups`` (see read_dupmap) back into the Newick string ``treestr``: the leaf of every
+    representative becomes a clade labeled 1 of the representative and its duplicates with zero edge lengths.
+    The labels of the tree are scanned once, so the running time is linear in the length of the string.
+    """
+    groups = {i[0]: i for i in dups if len(i) >= 2}
+    if not groups:
+        return treestr
+
+    def expand(match):
+        group = groups.pop(match.group(1), None)
+        if group is None:
+            return match.group(1)
+        return '(' + ':0,'.join(group) + ':0)1'
+
+    return LEAF_LABEL.sub(expand, treestr)
+
+
+def expand_dedupe_tree(tree, dups):
+    """
+    Tree counterpart of expand_dedupe_newick: every leaf labeled with the first name of a line of ``dups`` is
+    replaced, in place, by a node labeled 1 with the same edge length whose children are the leaves of all the
+    names of the line with zero edge lengths.
+    """
+    leaves = {leaf.label: leaf for leaf in tree.traverse_leaves()}
     for i in dups:
-        if len(i) >= 2:
-            if treestr.find('(' + i[0] + ':') != -1:
-                ex = '((' + ':0,'.join(i) + ':0)1:'
-                treestr = treestr.replace('(' + i[0] + ':', ex, 1)
-            elif treestr.find(',' + i[0] + ':') != -1:
-                ex = ',(' + ':0,'.join(i) + ':0)1:'
-                treestr = treestr.replace(',' + i[0] + ':', ex, 1)
-    return treestr
+        if len(i) >= 2 and i[0] in leaves:
+            leaf = leaves[i[0]]
+            parent = leaf.parent
+            if parent is None:
+                continue
+            clade = Node(label='1', edge_length=leaf.edge_length)
+            clade.parent = parent
+            parent.children[parent.children.index(leaf)] = clade
+            leaf.edge_length = 0.0
+            clade.add_child(leaf)
+            for name in i[1:]:
+                dup = Node(label=name, edge_length=0.0)
+                clade.add_child(dup)
+                leaves[name] = dup
@@ -36,22 +36,88 @@ def readfq(fp):   # this is a generator function
                 break
 
 
+def translation_table(prot_flag, mask_flag):
+    """
+    256-entry lookup table equivalent to the upper/mask translation followed by the invalid character
+    translation of the original per-sequence implementation.
+    """
+    table = np.arange(256, dtype=np.uint8)
+    lower = np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype=np.uint8)
+    if mask_flag:
+        table[lower] = ord('-')
+    else:
+        table[lower] = lower - (ord('a') - ord('A'))
+    if prot_flag:
+        invalid = np.frombuffer(b'BJOUXZ', dtype=np.uint8)
+    else:
+        invalid = np.frombuffer(b'BDEFHIJKLMNOPQRSUVWXYZ', dtype=np.uint8)
+    table[np.isin(table, invalid)] = ord('-')
+    return table
+
+
+def read_fasta_records(ref_fp, prot_flag, mask_flag):
+    """
+    Parse a whole FASTA file at once.
+    Returns the list of names, the translated sequences concatenated into a single uint8 array
+    and the offsets of the records in that array (record i is seqs[offsets[i]:offsets[i+1]]).
+    """
+    with open(ref_fp, 'rb') as f:
+        buf = f.read()
+    data = np.frombuffer(buf, dtype=np.uint8)
+    starts = np.flatnonzero(data == ord('>'))
+    if len(starts) == 0:
+        return [], np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+    # a '>' only starts a record at the beginning of a line
+    starts = starts[(starts == 0) | (data[starts - 1] == ord('\n'))]
+    newlines = np.flatnonzero(data == ord('\n'))
+    idx = np.searchsorted(newlines, starts)
+    header_ends = np.append(newlines, len(data))[idx]
+    record_ends = np.append(starts[1:], len(data))
+
+    # number of sequence bytes in each record
+    if b'\r' in buf:
+        breaks = np.flatnonzero((data == ord('\n')) | (data == ord('\r')))
+    else:
+        breaks = newlines
+    seq_starts = header_ends + 1
+    breaks_per_record = np.searchsorted(breaks, record_ends) - np.searchsorted(breaks, seq_starts)
+    lengths = np.maximum(record_ends - seq_starts, 0) - breaks_per_record
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # everything except headers and line breaks is sequence. a single pass of bytes.translate applies
+    # the lookup table and drops the line breaks
+    seq_bytes = b''.join([buf[s:e] for s, e in zip(seq_starts.tolist(), record_ends.tolist())])
+    table = translation_table(prot_flag, mask_flag).tobytes()
+    seqs = np.frombuffer(seq_bytes.translate(table, b'\n\r'), dtype=np.uint8)
+
+    names = [
+        buf[s + 1 : e].rstrip(b'\r').partition(b' ')[0].decode()
+        for s, e in zip(starts.tolist(), header_ends.tolist())
+    ]
+    return names, seqs, offsets
+
+
+def read_fasta_matrix(ref_fp, prot_flag, mask_flag):
+    """
+    Parse an alignment into a list of names and a 2D uint8 matrix (one row per record).
+    """
+    names, seqs, offsets = read_fasta_records(ref_fp, prot_flag, mask_flag)
+    lengths = np.diff(offsets)
+    length = int(lengths[0]) if len(names) else 0
+    if (lengths != length).any():
+        bad = int(np.flatnonzero(lengths != length)[0])
+        raise ValueError(
+            'Alignment %s is not a valid alignment: sequence %s has length %d instead of %d.'
+            % (ref_fp, names[bad], lengths[bad], length)
+        )
+    return names, seqs.reshape((len(names), length))
+
+
 def fasta2dic(ref_fp, prot_flag, mask_flag):
+    names, seqs, offsets = read_fasta_records(ref_fp, prot_flag, mask_flag)
+    seqs = seqs.view('S1')
     refs = {}
-    with open(ref_fp) as f:
-        mask_translation = str.maketrans('abcdefghijklmnopqrstuvwxyz', '-' * 26)
-
-        if prot_flag:
-            invalid_translation = str.maketrans('BJOUXZ', '-' * 6)
-        else:
-            invalid_translation = str.maketrans('BDEFHIJKLMNOPQRSUVWXYZ', '-' * 22)
-
-        def makeupper(s):
-            if mask_flag:
-                return s.translate(mask_translation)
-            else:
-                return s.upper()
-
-        for name, seq, qual in readfq(f):
-            refs[name] = np.frombuffer(makeupper(seq).translate(invalid_translation).encode(), dtype='S1')
+    for i, name in enumerate(names):
+        refs[name] = seqs[offsets[i] : offsets[i + 1]]
     return refs
@@ -5,6 +5,7 @@ set -euo pipefail
 # $3 char
 # $4 number of threads
 # $5 all alignments dir
+# $11 alignment store dir (see uDance/alignment_store.py)
 
 export ALN=$1
 export BBONE=$2
@@ -16,6 +17,7 @@ export APM=$7
 export APB=$8
 export APV=$9
 export MNTMP=${10}
+export STOREDIR=${11}
 
 export SCRIPTS_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" &>/dev/null && pwd)"
 
@@ -82,6 +84,6 @@ fi
 TreeCluster.py -i $MNTMP/backbone_thirdstage.tree -m max -t 0.7 > $MNTMP/clusters.txt
 
 python -c "from uDance.occupancy_outliers import occupancy_outliers; \
-           occupancy_outliers(\"$ALLALNS\", \"$MNTMP/clusters.txt\", \"$CHARTYPE\"=='prot')" >$MNTMP/removedthirdstage.tsv
+           occupancy_outliers(\"$ALLALNS\", \"$MNTMP/clusters.txt\", \"$CHARTYPE\"=='prot', \"$STOREDIR\")" >$MNTMP/removedthirdstage.tsv
 cat $MNTMP/removedsecondstage.tsv $MNTMP/removedthirdstage.tsv
 
@@ -0,0 +1,142 @@
+import json
+import re
+
+import numpy as np
+
+READ_CHUNK_SIZE = 1 << 24
+PLACEMENT_BATCH_SIZE = 1 << 16
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+
+class PlacementIndex:
+    """Placements of a jplace file, grouped by edge (CSR layout).
+
+    Query names are interned once: ``names[q]`` is the name of query id ``q``. The ids of the queries placed on
+    edge ``e`` are ``ids[indptr[e]:indptr[e + 1]]``, in the order in which they appear in the jplace file.
+    """
+
+    def __init__(self, names, indptr, ids):
+        self.names = names
+        self.indptr = indptr
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def edge(self, edge_index):
+        """ids of the queries placed on ``edge_index`` (a view, empty if nothing is placed on it)"""
+        if edge_index + 1 >= len(self.indptr):
+            return self.ids[:0]
+        return self.ids[self.indptr[edge_index] : self.indptr[edge_index + 1]]
+
+
+class _JsonStream:
+    """
+    Minimal incremental JSON reader: top-level values are decoded one at a time with raw_decode
+    from a buffer that is refilled from the file as needed.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        # drop the consumed part of the buffer
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """next non-whitespace character, or '' at the end of the file"""
+        while True:
+            end = WHITESPACE.match(self.buf, self.pos).end()
+            if end < len(self.buf) or self.eof:
+                self.pos = end
+                return self.buf[end : end + 1]
+            self._fill()
+
+    def skip(self, c):
+        """skip the next non-whitespace character if it is ``c``"""
+        if self.peek() == c:
+            self.pos += 1
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('Invalid jplace file: expected %r at offset %d' % (c, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = DECODER.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def read_jplace(jplace_fp, batch_size=PLACEMENT_BATCH_SIZE):
+    """
+    Read a jplace file without loading the whole document in memory. Placement records are streamed and
+    collected, in batches of ``batch_size`` queries, into compact arrays of edge indices and query ids.
+    Like the original aggregation, the i-th name of a record is placed on the edge of the i-th placement of
+    the record.
+    Returns the Newick string of the tree and the ``PlacementIndex`` of the placements.
+    """
+    tree = None
+    name_to_id = dict()
+    names = []
+    edge_batches, id_batches = [], []
+    edges, ids = [], []
+
+    def flush():
+        edge_batches.append(np.array(edges, dtype=np.int64))
+        id_batches.append(np.array(ids, dtype=np.int64))
+        edges.clear()
+        ids.clear()
+
+    with open(jplace_fp) as f:
+        stream = _JsonStream(f)
+        stream.expect('{')
+        while stream.peek() != '}':
+            key = stream.value()
+            stream.expect(':')
+            if key == 'placements':
+                stream.expect('[')
+                while stream.peek() != ']':
+                    placement = stream.value()
+                    for i, seqname in enumerate(placement['n']):
+                        if seqname not in name_to_id:
+                            name_to_id[seqname] = len(names)
+                            names.append(seqname)
+                        edges.append(placement['p'][i][0])
+                        ids.append(name_to_id[seqname])
+                    if len(ids) >= batch_size:
+                        flush()
+                    stream.skip(',')
+                stream.expect(']')
+            elif key == 'tree':
+                tree = stream.value()
+            else:
+                stream.value()
+            stream.skip(',')
+    flush()
+    if tree is None:
+        raise ValueError('Invalid jplace file: %s has no tree' % jplace_fp)
+
+    edges = np.concatenate(edge_batches)
+    ids = np.concatenate(id_batches)
+    order = np.argsort(edges, kind='stable')
+    indptr = np.zeros((edges.max() + 2) if len(edges) else 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges), out=indptr[1:])
+    return tree, PlacementIndex(names, indptr, ids[order])
@@ -4,28 +4,41 @@
 # take alignment or alignment directory as input
 # sample sites from the alignment and concatenate them
 # run fasttree
-# run treecluster-max in binary search mode to reach the desire number of clusters
+# cluster the tree with treecluster-max, using the threshold that gives the desired number of clusters
 # designate the highest occupancy species as representative of the cluster
 # return the alignment(s) induced to set of representatives.
+import hashlib
+import heapq
+import json
+import os
+import shutil
 import sys
 import tempfile
 from functools import reduce
 from os import listdir
-from os.path import isfile, join
-from subprocess import Popen, PIPE, call
+from os.path import abspath, expanduser, isfile, join
+from pathlib import Path
+from subprocess import Popen, PIPE
 
 import numpy as np
 import treeswift as ts
+from scipy.sparse import csr_matrix
 
-from uDance.fasta2dic import fasta2dic
-from uDance.tc_parser import tc_parser
+from uDance.alignment_store import open_alignment
+from uDance.treecluster_max import max_diameter_thresholds
 
-BINARY_SEARCH_STOP_MULTIPLIER = 0.0001
+# number of taxa whose concatenated sequences are assembled and written to fasttree at a time
+CONCAT_BLOCK_SIZE = 4096
+MAINLINES_SEED = 42
+# the FastTree trees of previous runs are cached (see cache_key); the version is part of the key
+MAINLINES_CACHE_VERSION = 2
+# the input alignments are hashed for the cache key in chunks of this many bytes
+DIGEST_CHUNK_SIZE = 1 << 24
 
 
-def fasta2mat(ref_fp, prot_flag, mask_flag):
-    d = fasta2dic(ref_fp, prot_flag, mask_flag)
-    return np.array(list(d.keys())), np.array(list(d.values()))
+def fasta2mat(ref_fp, prot_flag, mask_flag, store_dir=None):
+    store = open_alignment(ref_fp, prot_flag, mask_flag, store_dir)
+    return np.array(store.names), store.matrix.view('S1')
 
 
 def gap_filter(names, mats, thr=0.95):
@@ -45,141 +58,279 @@ def subsample_align(nm, mins, size):
     np.random.shuffle(scores_3)
     order = sorted(zip(scores_1, scores_2, scores_3, range(len(scores_1))), reverse=True)[:size]
     selected = [i for _, _, _, i in order]
-    res = np.full((len(mins), len(selected)), b'-')
-    res[name, :] = mats[:, selected]
-    return res
+    return mats[:, selected]
 
 
-def mainlines(options):
-    only_files = sorted(
-        [
-            join(options.alignment_dir_fp, f)
-            for f in listdir(options.alignment_dir_fp)
-            if isfile(join(options.alignment_dir_fp, f)) and not f.startswith('.')
-        ]
+def greedy_subsamples(names, load, num_taxa, size):
+    """
+    Subsample the genes greedily: the next gene is the one with most copies of the least occupant taxa so far
+    (on ties, the one with most taxa, then the first one) and its subsample (see subsample_align) increases the
+    occupancy of the taxa it covers. ``names[i]`` are the taxon ids of gene ``i`` and ``load(i)`` its matrix,
+    which is loaded only when the gene is chosen. Returns the (taxon ids, subsample) pairs in the order in which
+    the genes are chosen.
+
+    The scores (number of least occupant taxa of each gene) are maintained incrementally from a sparse gene by
+    taxon membership matrix: only the genes of the taxa that leave the least occupant set are updated, and all
+    scores are recomputed only when the minimum occupancy increases. The best gene is found with a heap whose
+    outdated entries are skipped when they are popped.
+    """
+    num_genes = len(names)
+    ntaxa = [len(n) for n in names]
+    membership = csr_matrix(
+        (
+            np.ones(sum(ntaxa), dtype=np.int64),
+            np.concatenate(names).astype(np.int64),
+            np.concatenate([[0], np.cumsum(ntaxa)]),
+        ),
+        shape=(num_genes, num_taxa),
     )
-    np.random.seed(42)
-    gap_thr = options.gap_threshold
+    genes_of_taxa = membership.T.tocsr()
+
+    chosen = np.zeros(num_genes, dtype=bool)
+    spec_counts = np.zeros(num_taxa, dtype=np.int64)
+    min_count = 0
+    num_at_min = num_taxa
+    scores = membership @ np.ones(num_taxa, dtype=np.int64)
+    heap = [(-scores[i], -ntaxa[i], i) for i in range(num_genes)]
+    heapq.heapify(heap)
+
+    subsamples = []
+    for _ in range(num_genes):
+        while True:
+            score, _, maxind = heapq.heappop(heap)
+            if not chosen[maxind] and -score == scores[maxind]:
+                break
+        name = names[maxind]
+        subsample = subsample_align((name, load(maxind)), spec_counts == min_count, size)
+        subsamples.append((name, subsample))
+        chosen[maxind] = True
+
+        covered = name[~(subsample == b'-').all(axis=1)]
+        leaving = covered[spec_counts[covered] == min_count]
+        spec_counts[covered] += 1
+        num_at_min -= len(leaving)
+        if num_at_min == 0:
+            min_count = spec_counts.min()
+            mins = spec_counts == min_count
+            num_at_min = np.count_nonzero(mins)
+            scores = membership @ mins.astype(np.int64)
+            heap = [(-scores[i], -ntaxa[i], i) for i in range(num_genes) if not chosen[i]]
+            heapq.heapify(heap)
+        elif len(leaving):
+            rows = genes_of_taxa[leaving]
+            np.subtract.at(scores, rows.indices, rows.data)
+            for i in np.unique(rows.indices).tolist():
+                if not chosen[i]:
+                    heapq.heappush(heap, (-scores[i], -ntaxa[i], i))
+    return subsamples
+
+
+def write_concatenation(out, subsamples, id_to_name, block_size=CONCAT_BLOCK_SIZE):
+    """
+    Write the concatenation of the (taxon ids, subsample) pairs as FASTA to the binary stream ``out``, with a
+    record for every taxon of ``id_to_name`` (gaps for the genes it is missing from). Taxa are written
+    ``block_size`` at a time, so only one block of the concatenation is ever held as a full matrix.
+    """
+    offsets = np.cumsum([0] + [sub.shape[1] for _, sub in subsamples])
+    orders = [np.argsort(name, kind='stable') for name, _ in subsamples]
+    sorted_names = [name[order] for (name, _), order in zip(subsamples, orders)]
+    for start in range(0, len(id_to_name), block_size):
+        stop = min(start + block_size, len(id_to_name))
+        block = np.full((stop - start, offsets[-1]), b'-')
+        for (name, sub), order, sname, lo, hi in zip(subsamples, orders, sorted_names, offsets[:-1], offsets[1:]):
+            rows = order[np.searchsorted(sname, start) : np.searchsorted(sname, stop)]
+            block[name[rows] - start, lo:hi] = sub[rows]
+        out.write(
+            b''.join(
+                b'>' + id_to_name[start + i].encode() + b'\n' + block[i].tobytes() + b'\n' for i in range(stop - start)
+            )
+        )
+
+
+def build_tree(only_files, options, concat_out=None):
+    """
+    Concatenate subsamples of the genes and infer their FastTree tree. The concatenation is also written to the
+    binary stream ``concat_out`` if given. Returns the tree (Newick string), the sorted taxon names and their total
+    median-normalized occupancy scores.
+    """
+    np.random.seed(MAINLINES_SEED)
     concat_len = options.concat_length
-    target_num = options.target_num
-    names_and_mats = [fasta2mat(f, options.protein_seqs, False) for f in only_files]
-    # names_and_mats_ungapped = [gap_filter(n, m, gap_thr) for n, m in names_and_mats]
-    names_and_mats_ungapped = names_and_mats
+    # first pass: the taxa of every gene and their number of non-gap characters
+    gene_names, non_gap_counts = [], []
+    for f in only_files:
+        n, m = fasta2mat(f, options.protein_seqs, False, options.store_dir)
+        gene_names.append(n)
+        non_gap_counts.append(np.sum(m != b'-', axis=1))
     # union all taxon names
-    catalog = reduce(np.union1d, [n for n, m in names_and_mats_ungapped])
+    catalog = reduce(np.union1d, gene_names)
     # create bidirectional map before substituting taxon names with numbers
     id_to_name = dict(enumerate(catalog))
     name_to_id = {j: i for i, j in id_to_name.items()}
     # substitute names with ids
-    names_and_mats_ungapped = [(np.array([name_to_id[ni] for ni in n]), m) for n, m in names_and_mats_ungapped]
+    gene_names = [np.array([name_to_id[ni] for ni in n]) for n in gene_names]
 
-    def gen_med_score(nm):
+    def gen_med_score(name, non_gap_count):
         """
         compute occupancy scores for each taxa. Occupancy score is a real number between 0 and 1.
         the score is equal to min(1,taxa_nongap_length/median_nongap_length)
         """
-        name, mats = nm
-        non_gap_count = np.sum(mats != b'-', axis=1)
         med_scores = np.clip(non_gap_count / np.median(non_gap_count), 0, 1)
         med_scores_with_zeros = np.zeros(len(catalog))
         med_scores_with_zeros[name] = med_scores
         return med_scores_with_zeros
 
     # compute total median-normalized occupancy scores per taxa
-    tot_med_scores = sum([gen_med_score(nm) for nm in names_and_mats_ungapped])
+    tot_med_scores = sum([gen_med_score(n, c) for n, c in zip(gene_names, non_gap_counts)])
 
-    spec_counts = np.array(len(catalog) * [0])
-    sites_per_gene = int(np.ceil(concat_len / len(names_and_mats_ungapped)))
-    subsamples = []
-    while names_and_mats_ungapped:
-        # find the least occupant taxa until this iteration
-        mins = spec_counts == min(spec_counts)
-        # find the gene with most copies of the least occupant taxa
-        scores = [np.sum(mins[n], axis=0) for n, _ in names_and_mats_ungapped]
-        # if there is a tie, pick the gene with most taxa (ignore occupancy)
-        tiebraker_scores = [len(n) for n, _ in names_and_mats_ungapped]
-        max_scores = scores == max(scores)
-        maxind = np.argmax(tiebraker_scores * max_scores)
-
-        subsample = subsample_align(names_and_mats_ungapped[maxind], mins, sites_per_gene)
-        subsamples.append(subsample)
-        # update spec_counts
-        spec_counts += ~(subsample == b'-').all(axis=1)
-        # remove the processed alignment from the list of unprocessed
-        del names_and_mats_ungapped[maxind]
-
-    concat = np.concatenate(subsamples, axis=1)
-    # convert byte array to string
-    concat = [i.tobytes().decode('utf-8') for i in concat]
-    concat_fp = tempfile.NamedTemporaryFile(delete=False, mode='w+t')
+    # second pass: every gene is read again when it is chosen, and only its selected sites are kept
+    sites_per_gene = int(np.ceil(concat_len / len(gene_names)))
+    subsamples = greedy_subsamples(
+        gene_names,
+        lambda i: fasta2mat(only_files[i], options.protein_seqs, False, options.store_dir)[1],
+        len(catalog),
+        sites_per_gene,
+    )
     fasttree_log = tempfile.NamedTemporaryFile(delete=False, mode='w+t').name
-    fasttree_out = tempfile.NamedTemporaryFile(delete=False, mode='w+t').name
 
-    with open(concat_fp.name, 'w') as f:
-        for ids, seq in enumerate(concat):
-            f.write('>' + id_to_name[ids] + '\n')
-            f.write(seq + '\n')
-
-    # run fasttree and write its output to a file
+    # run fasttree
     if options.protein_seqs:
         s = ['fasttree', '-nopr', '-lg', '-log', fasttree_log]
     else:
         s = ['fasttree', '-nopr', '-gtr', '-nt', '-log', fasttree_log]
         # s = ["FastTree", "-nopr", "-gtr", "-nt", "-gamma", "-log", fasttree_log]
 
-    with open(concat_fp.name, 'r') as rf:
-        with Popen(s, stdout=PIPE, stdin=rf, stderr=sys.stderr) as p:
-            tree_string = p.stdout.read().decode('utf-8')
-            p.poll()
-            if p.returncode:
-                sys.stderr.write('FastTree returned a nonzero return code. Check your FastTreeMP installation.\n')
-                sys.stderr.write('Exiting.\n')
-                exit(p.returncode)
-            with open(fasttree_out, 'w') as fout:
-                fout.write(tree_string.strip() + '\n')
+    # the concatenation is streamed to fasttree, which reads all of its input before it writes the tree
+    with Popen(s, stdout=PIPE, stdin=PIPE, stderr=sys.stderr) as p:
+        try:
+            write_concatenation(p.stdin if concat_out is None else _Tee(p.stdin, concat_out), subsamples, id_to_name)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        tree_string = p.stdout.read().decode('utf-8')
+        p.wait()
+        if p.returncode:
+            sys.stderr.write('FastTree returned a nonzero return code. Check your FastTreeMP installation.\n')
+            sys.stderr.write('Exiting.\n')
+            exit(p.returncode)
     if not tree_string:
         sys.stderr.write('FastTree failed. Check your FastTreeMP installation.\n')
         exit(1)
+    return tree_string, catalog, tot_med_scores
 
-    tmax = ts.read_tree_newick(tree_string).diameter()
-    tmin = 0
-    tcur = tmax / 2
-    stop_cond = BINARY_SEARCH_STOP_MULTIPLIER * tmax
-
-    numiter = 0
-
-    treecluster_out = tempfile.NamedTemporaryFile(delete=False, mode='w+t').name
-    nldef = tempfile.NamedTemporaryFile(delete=True, mode='w+t')
-    clusters = None
-    num_clusters = 0
-    while tcur - tmin >= stop_cond and tmax - tcur >= stop_cond:
-        numiter += 1
-        # print(numiter)
-        s = ['TreeCluster.py', '-i', fasttree_out, '-m', 'max', '-t', str(tcur), '-o', treecluster_out]
-        retcode = call(s, stdout=nldef, stderr=nldef)
-        if retcode:
-            sys.stderr.write('Treecluster returned a nonzero return code. Check your TreeCluster installation.\n')
-            sys.stderr.write('Exiting.\n')
-            sys.exit(retcode)
-        clusters = tc_parser(treecluster_out)
-        num_singletons = sum([len(tags) for idx, tags in clusters if idx == '-1'])
-        num_clusters = len(clusters) + max(0, num_singletons - 1)
-        if num_clusters == target_num:
-            break
-        elif num_clusters < target_num:
-            tmax = tcur
-            tcur = (tmin + tcur) / 2
-        else:
-            tmin = tcur
-            tcur = (tmax + tcur) / 2
-
-    select = []
-    for ci, tags in clusters:
-        if ci == '-1':
-            select += tags
-        else:
-            hi_med, tag = sorted(zip(list(map(lambda x: tot_med_scores[name_to_id[x]], tags)), tags), reverse=True)[0]
-            select.append(tag)
+
+class _Tee:
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+
+def default_cache_dir():
+    return join(os.environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache'), 'udance', 'mainlines')
+
+
+def content_digest(path):
+    """sha256 of the contents of a file, read in chunks"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(only_files, options):
+    """
+    Key of the cached tree of a run: a hash of the contents of the input alignments (in the order they are
+    concatenated), the concatenation length, the character type and the random seed. Paths and modification times
+    are not part of the key, so the same alignments copied or touched elsewhere find the same entry. The number of
+    taxa to select is not part of the key either, since it only matters after the tree is inferred.
+    """
+    key = {
+        'version': MAINLINES_CACHE_VERSION,
+        'alignments': [content_digest(f) for f in only_files],
+        'length': options.concat_length,
+        'protein': options.protein_seqs,
+        'seed': MAINLINES_SEED,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def read_cache(entry):
+    """the tree, taxon names and occupancy scores of a cache entry, or None if the entry does not exist"""
+    if not (isfile(join(entry, 'tree.nwk')) and isfile(join(entry, 'scores.json'))):
+        return None
+    with open(join(entry, 'tree.nwk')) as f:
+        tree_string = f.read()
+    with open(join(entry, 'scores.json')) as f:
+        scores = json.load(f)
+    # mark the entry as recently used
+    os.utime(entry)
+    return tree_string, np.array(scores['names']), np.array(scores['scores'])
+
+
+def evict_cache(cache_dir, max_entries):
+    """remove the least recently used entries of the cache beyond the first ``max_entries``"""
+    entries = [join(cache_dir, e) for e in listdir(cache_dir) if not e.startswith('.')]
+    entries.sort(key=lambda e: os.stat(e).st_mtime_ns, reverse=True)
+    for entry in entries[max_entries:]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def mainlines(options):
+    only_files = sorted(
+        [
+            join(options.alignment_dir_fp, f)
+            for f in listdir(options.alignment_dir_fp)
+            if isfile(join(options.alignment_dir_fp, f)) and not f.startswith('.')
+        ]
+    )
+    target_num = options.target_num
+
+    cached = None
+    if options.cache_entries > 0:
+        cache_dir = abspath(expanduser(options.cache_dir)) if options.cache_dir else default_cache_dir()
+        entry = join(cache_dir, cache_key(only_files, options))
+        cached = read_cache(entry)
+    if cached is not None:
+        sys.stderr.write('Using the cached FastTree tree in %s\n' % entry)
+        tree_string, catalog, tot_med_scores = cached
+    elif options.cache_entries > 0:
+        # the entry is written in a hidden directory and renamed, so that it is complete when it appears
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(prefix='.', dir=cache_dir)
+        try:
+            with open(join(tmp_entry, 'concat.fasta'), 'wb') as concat_out:
+                tree_string, catalog, tot_med_scores = build_tree(only_files, options, concat_out)
+            with open(join(tmp_entry, 'tree.nwk'), 'w') as f:
+                f.write(tree_string)
+            with open(join(tmp_entry, 'scores.json'), 'w') as f:
+                json.dump({'names': catalog.tolist(), 'scores': tot_med_scores.tolist()}, f)
+        except BaseException:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # another run cached the same tree in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        evict_cache(cache_dir, options.cache_entries)
+    else:
+        tree_string, catalog, tot_med_scores = build_tree(only_files, options)
+    name_to_id = {j: i for i, j in enumerate(catalog)}
+
+    _, clusters = max_diameter_thresholds(ts.read_tree_newick(tree_string), [target_num])[target_num]
+
+    # the clusters are visited in the order of the TreeCluster output once sorted by cluster number:
+    # the singletons (cluster -1) first, then the other clusters by the string of their (1-based) number
+    singletons = [tags[0] for tags in clusters if len(tags) == 1]
+    groups = [tags for tags in clusters if len(tags) > 1]
+    select = list(singletons)
+    for ci in sorted(range(len(groups)), key=lambda x: str(x + 1)):
+        tags = groups[ci]
+        hi_med, tag = sorted(zip(list(map(lambda x: tot_med_scores[name_to_id[x]], tags)), tags), reverse=True)[0]
+        select.append(tag)
 
     for i in select:
         print(i)
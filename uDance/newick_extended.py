@@ -1,17 +1,25 @@
-import treeswift
+import gc
+import gzip
+import re
+from os.path import isfile
 
+import treeswift
 
-# store bracket open/close for convenience in label parsing
-BRACKET = {
-    '[': ']',  # square bracket
-    '{': '}',  # curly bracket
-    "'": "'",  # single-quote
-    '"': '"',  # double-quote
-}
 
 INVALID_NEWICK = 'Tree not valid Newick tree'
 
 
+# a Newick string is split into two kinds of tokens:
+#   1: one of the structural characters ( ) , ;
+#   2, 3, 4: the label of a node (quoted or bracketed parts of which may contain any character) and/or its edge length
+#            (possibly prefixed by bracketed edge params) with an optional jplace {edge_index}
+NEWICK_TOKEN = re.compile(
+    r"""([(),;])"""
+    r"""|(?=[^(),;])((?:'[^']*'|"[^"]*"|\[[^\]]*\]|\{[^}]*\}|[^:,;)'"\[{])+(?=[:,;)]))?"""
+    r"""(?::([^,);{]*)(?:\{([^}]*)\}|(?=[,);])))?"""
+)
+
+
 def read_tree_newick(newick):
     """Read a tree from a Newick string or file
 
@@ -27,8 +35,24 @@ def read_tree_newick(newick):
         except:
             raise TypeError('newick must be a str')
 
+    if newick.lower().endswith('.gz'):
+        with gzip.open(newick, 'rt') as f:
+            lines = f.read().strip().splitlines()
+    elif isfile(newick):
+        with open(newick) as f:
+            lines = f.read().strip().splitlines()
+    else:
+        return _parse_newick(newick)
+    trees = [_parse_newick(line) for line in lines if line.strip()]
+    if len(trees) == 1:
+        return trees[0]
+    return trees
+
+
+def _parse_newick(newick):
     ts = newick.strip()
 
+    gc_enabled = gc.isenabled()
     try:
         t = treeswift.Tree()
         t.is_rooted = ts.startswith('[&R]')
@@ -36,70 +60,58 @@ def read_tree_newick(newick):
             ts = ']'.join(ts.split(']')[1:]).strip()
             ts = ts.replace(', ', ',')
         n = t.root
-        i = 0
-        while i < len(ts):
-            # end of Newick string
-            if ts[i] == ';':
-                # if i != len(ts)-1 or n != t.root:
-                if i != len(ts) - 1:
-                    raise RuntimeError(INVALID_NEWICK)
+        pos = 0
+        gc.disable()
+        for m in NEWICK_TOKEN.finditer(ts):
+            start, end = m.span()
+            if start != pos or start == end:
+                raise RuntimeError(INVALID_NEWICK)
+            pos = end
+            symbol, label, ls, ei = m.groups()
 
             # go to new child
-            elif ts[i] == '(':
+            if symbol == '(':
                 c = treeswift.Node()
                 n.add_child(c)
                 n = c
 
             # go to parent
-            elif ts[i] == ')':
+            elif symbol == ')':
                 n = n.parent
 
             # go to new sibling
-            elif ts[i] == ',':
+            elif symbol == ',':
                 n = n.parent
                 c = treeswift.Node()
                 n.add_child(c)
                 n = c
 
-            # edge length
-            elif ts[i] == ':':
-                i += 1
-                ls = ''
-                while ts[i] != ',' and ts[i] != ')' and ts[i] != ';':
-                    if ts[i] == '{':
-                        ei = ''
-                        i += 1
-                        while ts[i] != '}':
-                            ei += ts[i]
-                            i += 1
-                        n.edge_index = int(ei)
-                        break
-                    ls += ts[i]
-                    i += 1
-                if ls[0] == '[':
-                    n.edge_params = ']'.join(ls.split(']')[:-1])
-                    ls = ls.split(']')[-1]
-                n.edge_length = float(ls)
-
-            # node label
+            # end of Newick string
+            elif symbol == ';':
+                if pos != len(ts):
+                    raise RuntimeError(INVALID_NEWICK)
+
             else:
-                label = ''
-                bracket = None
-                while (
-                    bracket is not None
-                    or ts[i] in BRACKET
-                    or (ts[i] != ':' and ts[i] != ',' and ts[i] != ';' and ts[i] != ')')
-                ):
-                    if ts[i] in BRACKET and bracket is None:
-                        bracket = ts[i]
-                    elif bracket is not None and ts[i] == BRACKET[bracket]:
-                        bracket = None
-                    label += ts[i]
-                    i += 1
-                i -= 1
-                n.label = label
-            i += 1
+                # node label
+                if label is not None:
+                    n.label = label
+
+                # edge length
+                if ls is not None:
+                    if ei is not None:
+                        n.edge_index = int(ei)
+                    if ls[0] == '[':
+                        n.edge_params = ']'.join(ls.split(']')[:-1])
+                        ls = ls.split(']')[-1]
+                    n.edge_length = float(ls)
+        if pos != len(ts):
+            raise RuntimeError(INVALID_NEWICK)
     except Exception as e:
         print(e)
         raise RuntimeError('Failed to parse string as Newick: %s' % ts)
+    finally:
+        # the tree is built without the overhead of the cyclic garbage collector, which would otherwise be run
+        # repeatedly over all the nodes allocated so far
+        if gc_enabled:
+            gc.enable()
     return t
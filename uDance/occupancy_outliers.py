@@ -8,8 +8,8 @@ from uDance.tc_parser import tc_parser
 from kmeans1d import cluster
 
 
-def occupancy_outliers(alignments_dir, clusters_file, protein):
-    occupancy, num_genes = count_occupancy(alignments_dir, protein)
+def occupancy_outliers(alignments_dir, clusters_file, protein, store_dir=None):
+    occupancy, num_genes = count_occupancy(alignments_dir, protein, store_dir=store_dir)
     clusters = tc_parser(clusters_file)
     deletedlist = []
     for n, clus in clusters:
@@ -3,7 +3,8 @@ import sys
 from multiprocessing import cpu_count
 from os.path import abspath, expanduser
 
-from uDance.decompose import decompose
+from uDance.alignment_store import default_store_dir
+from uDance.decompose import decompose, parse_values
 from uDance.mainlines import mainlines
 from uDance.refine import refine
 from uDance.stitch import stitch
@@ -79,6 +80,33 @@ def options_config():
         help='Alignment filtering threshold. '
         'Sites with a gappiness value larger than 1-gap_threshold will be removed.',
     )
+    parser_mainlines.add_argument(
+        '--store-dir',
+        dest='store_dir',
+        default=None,
+        help='directory where the alignments are converted to a binary format for faster reading. '
+        'Default: .udance_store in the working directory.',
+        metavar='DIRECTORY',
+    )
+    parser_mainlines.add_argument(
+        '--cache-dir',
+        dest='cache_dir',
+        default=None,
+        help='directory where the concatenated alignment (concat.fasta), the FastTree tree and the taxon occupancy '
+        'scores are cached (see --cache-entries), keyed by the contents of the input alignments, --length, the '
+        'character type and the random seed, so that runs that only change --number reuse the tree. '
+        'Default: $XDG_CACHE_HOME/udance/mainlines (~/.cache/udance/mainlines).',
+        metavar='DIRECTORY',
+    )
+    parser_mainlines.add_argument(
+        '--cache-entries',
+        type=int,
+        dest='cache_entries',
+        default=0,
+        help='maximum number of cached trees. The least recently used ones are removed. '
+        'Default: 0, i.e. the cache is disabled and nothing is written to --cache-dir.',
+        metavar='NUMBER',
+    )
     parser_mainlines.set_defaults(func=mainlines)
 
     # decompose command subparser
@@ -89,6 +117,17 @@ def options_config():
     parser_decompose.add_argument(
         '-t', '--threshold', dest='threshold', default='1000', help='maximum number of elements in each cluster'
     )
+    parser_decompose.add_argument(
+        '-b',
+        '--budget',
+        type=float,
+        dest='budget',
+        default=None,
+        help='per-partition compute budget, in the units of the cost model (uDance/cost_model.py). '
+        'If given, clusters are formed so that the estimated cost of inferring the gene trees and running ASTRAL '
+        'on each of them is about this budget, and --threshold is ignored.',
+        metavar='NUMBER',
+    )
     parser_decompose.add_argument(
         '-o',
         '--output',
@@ -105,6 +144,14 @@ def options_config():
         'containing reference and query sequences.',
         metavar='FILE',
     )
+    parser_decompose.add_argument(
+        '--store-dir',
+        dest='store_dir',
+        default=None,
+        help='directory where the alignments are converted to a binary format for faster reading and where '
+        'their occupancy index is kept. Default: .udance_store in the output directory.',
+        metavar='DIRECTORY',
+    )
     parser_decompose.add_argument(
         '-p',
         '--protein',
@@ -140,6 +187,16 @@ def options_config():
         help='minimum seqence(fragment) length needed to use in the subalignment',
         metavar='NUMBER',
     )
+    parser_decompose.add_argument(
+        '-G',
+        '--genes-in-flight',
+        type=int,
+        dest='genes_in_flight',
+        default=4,
+        help='maximum number of genes whose partition alignments are extracted at the same time. '
+        'Larger values keep the workers busier at the cost of memory.',
+        metavar='NUMBER',
+    )
     parser_decompose.add_argument(
         '-c',
         '--constrain-outgroups',
@@ -158,6 +215,22 @@ def options_config():
         default=1,
         help='number of tasks where local refinement jobs will be split.',
     )
+    parser_decompose.add_argument(
+        '--numstart',
+        type=int,
+        dest='num_starts',
+        metavar='NUMBER',
+        default=2,
+        help='number of starting trees of the gene tree inference commands written to the task files.',
+    )
+    parser_decompose.add_argument(
+        '--numthread',
+        type=int,
+        dest='infer_threads',
+        metavar='NUMBER',
+        default=1,
+        help='number of threads of the gene tree inference commands written to the task files.',
+    )
     parser_decompose.add_argument(
         '-C',
         '--occupancy',
@@ -169,11 +242,21 @@ def options_config():
     parser_decompose.add_argument(
         '-e',
         '--edge-threshold',
-        type=float,
         dest='edge_threshold',
-        default=0.1,
+        default='0.1',
         help='maximum edge length in a cluster.',
     )
+    parser_decompose.add_argument(
+        '--preview',
+        dest='preview',
+        action='store_true',
+        default=False,
+        help='only print the number, sizes, outgroups and estimated cost of the partitions that would be created, '
+        'without writing any partition. --threshold and --edge-threshold can then be comma-separated lists of values '
+        'and start:stop:step ranges, e.g. -t 500:2000:500 -e 0.02,0.05; every combination is shown. '
+        'Only the occupancy index of the alignments is read; the first run (or a run after the alignments change) '
+        'builds it by scanning the alignment headers into --store-dir.',
+    )
     parser_decompose.add_argument(
         '-m',
         '--method',
@@ -276,6 +359,16 @@ def options_config():
         help='gene occupancy threshold for inclusion in ASTRAL step.',
         metavar='NUMBER',
     )
+    parser_ref.add_argument(
+        '-s',
+        '--astral-split',
+        type=float,
+        dest='astral_split',
+        default=0.5,
+        help='fraction of the threads and memory given to the incremental ASTRAL run. The updates run gets the rest '
+        'and both run at the same time. 1 runs them one after the other with all the threads and memory.',
+        metavar='NUMBER',
+    )
     parser_ref.set_defaults(func=refine)
 
     # stitch command subparser
@@ -315,5 +408,22 @@ def options_config():
         options.output_fp = abspath(expanduser(options.output_fp))
     if hasattr(options, 'cluster_dir'):
         options.cluster_dir = abspath(expanduser(options.cluster_dir))
+    if hasattr(options, 'edge_threshold'):
+        # a list or range of edge thresholds is only meaningful with --preview; a normal run needs a single value
+        try:
+            edge_thresholds = parse_values(options.edge_threshold)
+        except ValueError:
+            parser_decompose.error('argument -e/--edge-threshold: invalid value: %r' % options.edge_threshold)
+        if not options.preview:
+            if len(edge_thresholds) != 1:
+                parser_decompose.error(
+                    'argument -e/--edge-threshold: expected a single value without --preview: %r'
+                    % options.edge_threshold
+                )
+            options.edge_threshold = edge_thresholds[0]
+    if hasattr(options, 'store_dir'):
+        if options.store_dir is None:
+            options.store_dir = default_store_dir(getattr(options, 'output_fp', None))
+        options.store_dir = abspath(expanduser(options.store_dir))
 
     return options
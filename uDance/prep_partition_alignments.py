@@ -1,33 +1,56 @@
 import multiprocessing as mp
+from collections import deque
 
 from uDance.PoolAlignmentWorker import PoolAlignmentWorker
-from uDance.fasta2dic import fasta2dic
 
 from os import listdir
 from os.path import isfile, join, splitext
 
 
 def prep_partition_alignments(
-    alndir, protein_flag, species_path_list, num_thread, subalignment_length, fragment_length
+    alndir,
+    protein_flag,
+    species_path_list,
+    num_thread,
+    subalignment_length,
+    fragment_length,
+    genes_in_flight=4,
+    store_dir=None,
 ):
     only_files = [f for f in listdir(alndir) if isfile(join(alndir, f)) and not f.startswith('.')]
+    genes_in_flight = max(1, genes_in_flight)
     all_scripts = []
-    for aln in only_files:
-        aln_input_file = join(alndir, aln)
-        basename = splitext(aln)[0]
-        # try:
-        fa_dict = fasta2dic(aln_input_file, protein_flag, False)
-        alignment_worker = PoolAlignmentWorker()
-        alignment_worker.set_class_attributes(subalignment_length, fragment_length, fa_dict, basename)
-        pool = mp.Pool(num_thread)
-        scripts = pool.map(alignment_worker.worker, species_path_list)
-        pool.close()
-        pool.join()
-        valid_scripts = [s for s in scripts if s is not None]
-        all_scripts += valid_scripts
-        # main_script.write("\n".join(valid_scripts))
-        # main_script.write("\n")
-        # except Exception as e:
-        #     print(e)
-        #     print("Alignment %s is not a valid fasta alignment" % aln_input_file, file=sys.stderr)
+    # a single pool for all (gene, partition) tasks. workers read the alignments from the memory-mapped
+    # alignment store, so only file paths and indices are sent to them.
+    with mp.Pool(
+        num_thread,
+        initializer=PoolAlignmentWorker.set_class_attributes,
+        initargs=(subalignment_length, fragment_length, protein_flag, species_path_list, store_dir),
+    ) as pool:
+        genes = iter(only_files)
+        conversions = deque()
+        extractions = deque()
+
+        def convert_next():
+            aln = next(genes, None)
+            if aln is not None:
+                conversions.append(
+                    (splitext(aln)[0], pool.apply_async(PoolAlignmentWorker.prepare, (join(alndir, aln),)))
+                )
+
+        # the next genes are converted to the alignment store while the partitions of the current ones are
+        # extracted. at most genes_in_flight genes are being extracted at any time, which bounds the number of
+        # alignments mapped by the workers and the results held by this process.
+        for _ in range(genes_in_flight):
+            convert_next()
+        while conversions:
+            basename, conversion = conversions.popleft()
+            prefix = conversion.get()
+            tasks = [(prefix, basename, i) for i in range(len(species_path_list))]
+            extractions.append(pool.starmap_async(PoolAlignmentWorker.worker, tasks))
+            convert_next()
+            if len(extractions) >= genes_in_flight:
+                all_scripts += [s for s in extractions.popleft().get() if s is not None]
+        while extractions:
+            all_scripts += [s for s in extractions.popleft().get() if s is not None]
     return all_scripts
@@ -1,14 +1,115 @@
-from os.path import join
+import multiprocessing as mp
+import os
+from collections import deque
+from os.path import getsize, isfile, join
 from glob import glob
 import numpy as np
 from pathlib import Path
+from uDance.expand_dedupe_newick import read_dupmap
 from uDance.fasta2dic import readfq
-from scipy.sparse.csgraph import connected_components
+from scipy.sparse import coo_matrix, csr_matrix, save_npz, triu
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
 import time
 import treeswift as ts
 
+# number of identical pairs collected before they are added to the sparse pair counts
+PAIR_BATCH_SIZE = 1 << 24
 
-def subsample_partition(partition_output_dir, limit):
+
+def count_identical_pairs(genes, name_to_ind):
+    """
+    Count in how many genes each species is present (counts_i) and in how many genes two species are identical
+    (counts_ij), for the species in ``name_to_ind``. Identical species are read from the dupmap.txt file of every gene:
+    every line lists a representative and the names of its duplicates, and pairs of the duplicates are counted.
+    counts_ij is a symmetric sparse matrix (CSR) with an entry for every pair that is identical in at least one gene,
+    so its size grows with the number of identical pairs.
+    """
+    numspecies = len(name_to_ind)
+    counts_i = np.zeros((numspecies,), dtype=np.int32)
+    counts_ij = csr_matrix((numspecies, numspecies), dtype=np.int32)
+    rows, cols = [], []
+    batch = 0
+
+    def flush():
+        pairs = coo_matrix(
+            (np.ones(batch, dtype=np.int32), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(numspecies, numspecies),
+        )
+        rows.clear()
+        cols.clear()
+        return counts_ij + pairs.tocsr()
+
+    for g in genes:
+        with open(join(g, 'aln.fa')) as af:
+            glabels = [name_to_ind[name] for name, seq, _ in readfq(af) if name in name_to_ind]
+            np.add.at(counts_i, glabels, 1)
+
+        dupmap_path = Path(join(g, 'dupmap.txt'))
+        if not dupmap_path.is_file():  # every sequence in the alignment is unique
+            continue
+        for group in read_dupmap(dupmap_path):
+            things = np.array([name_to_ind[j] for j in group[1:] if j in name_to_ind], dtype=int)
+            np.add.at(counts_i, things, 1)
+            # each unordered pair once; the matrix is symmetrized at the end
+            i, j = np.triu_indices(len(things), 1)
+            rows.append(things[i])
+            cols.append(things[j])
+            batch += len(i)
+            if batch >= PAIR_BATCH_SIZE:
+                counts_ij = flush()
+                batch = 0
+    if batch:
+        counts_ij = flush()
+    counts_ij = (counts_ij + counts_ij.T).tocsr()
+    counts_ij.sort_indices()
+    return counts_i, counts_ij
+
+
+def similarity_components(x, limit):
+    """
+    Connected components of the graph with an edge between i and j when x[i, j] >= cutoff/100, at the largest cutoff
+    in 99, 98, ..., 1 that gives fewer than ``limit`` components (or at 1 if none does). A maximum spanning forest of
+    the sparse symmetric similarity matrix ``x`` is built once: the graph of a cutoff has n - (number of forest edges
+    with similarity >= cutoff/100) components, so the component counts of all the cutoffs are found with a single
+    searchsorted over the sorted forest similarities, and the components are computed only at the chosen cutoff.
+    Returns the cutoff, the number of components and the component label of each species (only the grouping is
+    meaningful).
+    """
+    n = x.shape[0]
+    upper = triu(x, 1, format='coo')
+    order = np.argsort(-upper.data, kind='stable')
+    similarities = upper.data[order]
+    # the forest is built over the ranks of the pairs by decreasing similarity (from 1, since minimum_spanning_tree
+    # ignores zero weights), so that the similarity of every forest edge is read back exactly
+    ranks = coo_matrix(
+        (np.arange(1, len(order) + 1, dtype=np.float64), (upper.row[order], upper.col[order])), shape=(n, n)
+    )
+    forest = minimum_spanning_tree(ranks).tocoo()
+    forest_similarities = similarities[forest.data.astype(np.int64) - 1]
+
+    cutoffs = np.arange(99, 0, -1)
+    # number of components at every cutoff: n minus the number of forest edges with similarity >= cutoff/100
+    sorted_forest_similarities = np.sort(forest_similarities)
+    counts = n - (len(sorted_forest_similarities) - np.searchsorted(sorted_forest_similarities, cutoffs / 100))
+    below = np.flatnonzero(counts < limit)
+    chosen = below[0] if len(below) else len(cutoffs) - 1
+    cutoff = int(cutoffs[chosen])
+
+    keep = forest_similarities >= cutoff / 100
+    graph = coo_matrix(
+        (np.ones(np.count_nonzero(keep), dtype=np.int8), (forest.row[keep], forest.col[keep])), shape=(n, n)
+    )
+    curr, labels = connected_components(graph, directed=False)
+    return cutoff, curr, labels
+
+
+def prune_partition(partition_output_dir, limit):
+    """
+    Groups the species of the partition that are identical in most of their genes (see similarity_components) until
+    fewer than ``limit`` remain, keeps the first species of every group and removes the others from species.txt.
+    Returns the groups in dedupe_map.txt format, the set of removed species and the gene directories, whose
+    alignments still have to be rewritten with rewrite_gene.
+    """
     with open(join(partition_output_dir, 'species.txt')) as f:
         species = set(map(lambda x: x.strip(), f.readlines()))
     t = ts.read_tree_newick(join(partition_output_dir, 'astral_constraint.nwk'))
@@ -20,79 +121,21 @@ def subsample_partition(partition_output_dir, limit):
     numspecies = len(species)
     ind_to_name = dict(enumerate(species))
     name_to_ind = {v: k for k, v in ind_to_name.items()}
-    counts_ij = np.zeros((numspecies, numspecies), dtype=np.int16)  # counts in how many genes i and j are are identical
-    counts_i = np.zeros((numspecies,), dtype=np.int16)
     genes = glob(join(partition_output_dir, '*', ''))
     print('number of genes %d. ' % len(genes))
 
     start = time.time()
-    for g in genes:
-        with open(join(g, 'aln.fa')) as af:
-            glabels = [name_to_ind[name] for name, seq, _ in readfq(af) if name in name_to_ind]
-            for i in glabels:
-                counts_i[i] += 1
-
-        dupmap_path = Path(join(g, 'dupmap.txt'))
-        if not dupmap_path.is_file():  # every sequence in the alignment is unique
-            continue
-        with open(dupmap_path) as f:
-            for line in f.readlines():
-                things = [name_to_ind[j] for j in line.strip().split('\t')[1:] if j in name_to_ind]
-                for i in things:
-                    counts_i[i] += 1
-
-                # here, if and else does the same thing. The only purpose of the if..else.. is to improve performance
-                if len(things) <= np.sqrt(numspecies):
-                    for i in things:
-                        for j in things:
-                            if i == j:
-                                continue
-                            counts_ij[i][j] += 1
-                else:
-                    dupcounts_i = np.zeros((numspecies,), dtype=np.int16)
-                    for i in things:
-                        dupcounts_i[i] = 1
-                    dupcounts_ij = np.logical_and(dupcounts_i[..., np.newaxis], dupcounts_i[np.newaxis, ...]).astype(
-                        np.int16
-                    )
-                    # np.fill_diagonal(dupcounts_ij, 0)
-                    counts_ij += dupcounts_ij
-
+    counts_i, counts_ij = count_identical_pairs(genes, name_to_ind)
     print('counting neigh %.3f.' % (time.time() - start))
-    # print(counts_ij[52][53], counts_i[52], counts_i[53])
     start = time.time()
-    # print (counts_ij)
-    # print((counts_ij/np.minimum(counts_i[...,np.newaxis],counts_i[np.newaxis,...])).max())
-    x = counts_ij / np.minimum(counts_i[..., np.newaxis], counts_i[np.newaxis, ...])
-    x.dump(join(partition_output_dir, 'adj_mat.pkl'), protocol=4)
-    # print(x)
-
-    #    clow = 1
-    #    chigh = 100
-    #
-    #    while chigh > clow or chigh == 2:
-    #        cutoff = (chigh + clow + 1)//2
-    #        print(clow, cutoff, chigh)
-    #        y = (x >= (cutoff/100))
-    #        n, components = connected_components(y)
-    #        if limit < n:
-    #            chigh = cutoff-1
-    #        elif limit > n:
-    #            clow = cutoff
-    #        else:
-    #            clow = cutoff
-    #            chigh = cutoff # making sure clow=chigh always holds at the exit. we will print that.
-    #            break
-
-    cutoff = 100
-    curr = numspecies
-    while cutoff >= 2:
-        cutoff -= 1
-        y = x >= (cutoff / 100)
-        n, components = connected_components(y)
-        curr = n
-        if curr < limit:
-            break
+    # fraction of the genes of i or j (whichever is in fewer genes) where i and j are identical, for the pairs that
+    # are identical in at least one gene
+    rows = np.repeat(np.arange(numspecies), np.diff(counts_ij.indptr))
+    ratios = counts_ij.data / np.minimum(counts_i[rows], counts_i[counts_ij.indices])
+    x = csr_matrix((ratios, counts_ij.indices, counts_ij.indptr), shape=counts_ij.shape)
+    save_npz(join(partition_output_dir, 'adj_mat.npz'), x)
+
+    cutoff, curr, components = similarity_components(x, limit)
 
     print(
         'Partition '
@@ -121,7 +164,7 @@ def subsample_partition(partition_output_dir, limit):
             f.write(dupmapstr)
 
     if len(pruned_species) == 0:
-        return ''
+        return '', set(), genes
     pruned_species = set(pruned_species)
 
     # remove pruned from species.txt
@@ -130,50 +173,85 @@ def subsample_partition(partition_output_dir, limit):
     newspecieslst = list(prevspecies.difference(pruned_species))
     with open(join(partition_output_dir, 'species.txt'), 'w') as f:
         f.write('\n'.join(newspecieslst) + '\n')
+    return dupmapstr, pruned_species, genes
 
-    for g in genes:
-        aln_dict = dict()
-        with open(join(g, 'aln.fa')) as af:
-            for name, seq, _ in readfq(af):
-                aln_dict[name] = seq
 
-        # expands dups
-        dupmap_path = Path(join(g, 'dupmap.txt'))
-        if dupmap_path.is_file():
-            with open(dupmap_path) as f:
-                for line in f.readlines():
-                    things = line.strip().split('\t')
-                    for i in things[1:]:
-                        aln_dict[i] = aln_dict[things[0]]
-        for i in pruned_species:
-            if i in aln_dict:
-                del aln_dict[i]
-
-        # deduplicate the alignment
-        seq_keyed_dict = {}
-        for name, seq in aln_dict.items():
-            if seq in seq_keyed_dict:
-                seq_keyed_dict[seq].append(name)
-            else:
-                seq_keyed_dict[seq] = [name]
-
-        if len(seq_keyed_dict) >= 4:
-            # write trimmed MSA fasta
-            res = []
-            duplist = []
-            for k, v in seq_keyed_dict.items():
-                res.append('>' + v[0])
-                res.append(k)
-                if len(v) > 1:
-                    duplist.append('\t'.join(v))
-
-            aln_output_path = join(g, 'aln.fa')
-            with open(aln_output_path, 'w', buffering=100000000) as f:
-                f.write('\n'.join(res))
-                f.write('\n')
-            if duplist:
-                dupmap_output_path = join(g, 'dupmap.txt')
-                with open(dupmap_output_path, 'w', buffering=100000000) as f:
-                    f.write('\n'.join(duplist))
-                    f.write('\n')
+def rewrite_gene(g, pruned_species):
+    """
+    Removes the pruned species from the alignment (aln.fa and dupmap.txt) of the gene directory ``g``.
+    The alignment is already deduplicated: every sequence of aln.fa represents itself and the duplicates listed
+    after it in dupmap.txt. A group keeps its place and its representative unless the representative is pruned, in
+    which case its first remaining duplicate takes over the sequence. Groups with no remaining species are dropped.
+    aln.fa is streamed to a temporary file, so only the names are held in memory. The gene is left unchanged if
+    fewer than 4 distinct sequences would remain.
+    """
+    groups = dict()
+    dupmap_path = join(g, 'dupmap.txt')
+    if isfile(dupmap_path):
+        groups = {group[0]: group[1:] for group in read_dupmap(dupmap_path)}
+
+    tmp_suffix = '.%d.tmp' % os.getpid()
+    aln_path = join(g, 'aln.fa')
+    duplist = []
+    unique = 0
+    with open(aln_path) as af, open(aln_path + tmp_suffix, 'w') as f:
+        for name, seq, _ in readfq(af):
+            remaining = [i for i in [name] + groups.get(name, []) if i not in pruned_species]
+            if not remaining:
+                continue
+            f.write('>%s\n%s\n' % (remaining[0], seq))
+            if len(remaining) > 1:
+                duplist.append('\t'.join(remaining))
+            unique += 1
+    if unique < 4:
+        os.remove(aln_path + tmp_suffix)
+        return
+    os.replace(aln_path + tmp_suffix, aln_path)
+    if duplist:
+        with open(dupmap_path + tmp_suffix, 'w') as f:
+            f.write('\n'.join(duplist))
+            f.write('\n')
+        os.replace(dupmap_path + tmp_suffix, dupmap_path)
+    elif isfile(dupmap_path):
+        # every remaining sequence is unique
+        os.remove(dupmap_path)
+
+
+def subsample_partition(partition_output_dir, limit):
+    dupmapstr, pruned_species, genes = prune_partition(partition_output_dir, limit)
+    if pruned_species:
+        for g in genes:
+            rewrite_gene(g, pruned_species)
     return dupmapstr
+
+
+def prune_partitions(partition_dirs, limit, num_thread, memory_budget):
+    """
+    subsample_partition on every partition of ``partition_dirs`` with a pool of ``num_thread`` processes.
+    Partitions are pruned concurrently and the genes of every pruned partition are rewritten in parallel as soon as
+    its pruning is done. A gene rewrite holds one sequence and the names of the gene, so it is estimated to need at
+    most the size of its aln.fa; rewrites are submitted only while the estimates of the running ones add up to at most
+    ``memory_budget`` bytes (at least one runs at any time).
+    Returns the dupmap strings of the partitions, in the order of ``partition_dirs``.
+    """
+    dupmapstrs = []
+    with mp.Pool(num_thread) as pool:
+        prunings = [pool.apply_async(prune_partition, (d, limit)) for d in partition_dirs]
+        rewrites = deque()
+        in_flight = 0
+        for pruning in prunings:
+            dupmapstr, pruned_species, genes = pruning.get()
+            dupmapstrs.append(dupmapstr)
+            if not pruned_species:
+                continue
+            for g in genes:
+                estimate = getsize(join(g, 'aln.fa'))
+                while rewrites and in_flight + estimate > memory_budget:
+                    size, rewrite = rewrites.popleft()
+                    rewrite.get()
+                    in_flight -= size
+                rewrites.append((estimate, pool.apply_async(rewrite_gene, (g, pruned_species))))
+                in_flight += estimate
+        for _, rewrite in rewrites:
+            rewrite.get()
+    return dupmapstrs
@@ -0,0 +1,92 @@
+import numpy as np
+
+from uDance.treecluster_sum import paint, tree_to_arrays
+
+
+def max_diameter_clusters(parent, left, right, edge_length, threshold):
+    """
+    TreeCluster's "max" method (min_clusters_threshold_max) on a binary tree given as flat arrays (see
+    tree_to_arrays): split the leaves into the minimum number of clusters whose diameter (maximum pairwise
+    distance) is at most ``threshold``. Walking up the tree, whenever the farthest leaves below the two children
+    of a node are more than ``threshold`` apart, the child with the farther leaves is cut out as a cluster.
+    Returns the cluster of every node (clusters are numbered in the order in which they are cut; the leaves that
+    are never cut form the last cluster), the number of clusters and the interval [lo, hi) of thresholds over
+    which every decision, hence the clustering, stays the same.
+    """
+    n = len(parent)
+    farthest = [0.0] * n
+    deleted = [False] * n
+    painted = [-1] * n
+    cluster = 0
+    lo, hi = 0.0, float('inf')
+    for current in range(n):
+        l, r = left[current], right[current]
+        if l < 0:
+            continue
+        if deleted[l] and deleted[r]:
+            deleted[current] = True
+            continue
+        dl = 0 if deleted[l] else farthest[l] + edge_length[l]
+        dr = 0 if deleted[r] else farthest[r] + edge_length[r]
+        if dl + dr > threshold:
+            hi = min(hi, dl + dr)
+            if dl > dr:
+                cut, dl = l, 0
+            else:
+                cut, dr = r, 0
+            painted[cut] = cluster
+            deleted[cut] = True
+            cluster += 1
+        else:
+            lo = max(lo, dl + dr)
+        farthest[current] = max(dl, dr)
+    colors = paint(parent, painted)
+    remaining = colors < 0
+    if (remaining & (np.asarray(left) < 0)).any():
+        colors[remaining] = cluster
+        cluster += 1
+    return colors, cluster, lo, hi
+
+
+def max_diameter_thresholds(tree, targets):
+    """
+    Thresholds of max_diameter_clusters giving each of the ``targets`` numbers of clusters on ``tree``.
+    The number of clusters decreases with the threshold. Every run also gives the interval of thresholds over
+    which the clustering does not change, and the search excludes that whole interval, so it stops exactly at
+    the breakpoints of the number of clusters instead of when the range of thresholds becomes small. If no
+    threshold gives exactly a target, the clustering with the closest number of clusters (the larger one on ties)
+    is used.
+    Returns a dictionary mapping each target to the threshold and the clusters (lists of leaf labels, in the
+    order in which they were cut).
+    """
+    nodes, parent, left, right, edge_length = tree_to_arrays(tree, 0)[:5]
+    leaves = np.flatnonzero(np.asarray(left) < 0)
+    runs = dict()
+
+    def run(threshold):
+        if threshold not in runs:
+            runs[threshold] = max_diameter_clusters(parent, left, right, edge_length, threshold)
+        return runs[threshold]
+
+    result = dict()
+    for target in targets:
+        # thresholds below lo give more clusters than the target, thresholds at or above hi give fewer
+        lo, hi = 0.0, sum(edge_length) + 1
+        best = None
+        while lo < hi:
+            threshold = (lo + hi) / 2
+            colors, count, start, end = run(threshold)
+            if best is None or (abs(count - target), -count) < (abs(best[2] - target), -best[2]):
+                best = (threshold, colors, count)
+            if count == target:
+                break
+            if count > target:
+                lo = end
+            else:
+                hi = start
+        threshold, colors, count = best
+        clusters = [[] for _ in range(count)]
+        for i in leaves.tolist():
+            clusters[colors[i]].append(nodes[i].label)
+        result[target] = (threshold, clusters)
+    return result
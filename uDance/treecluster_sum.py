@@ -1,106 +1,185 @@
-from collections import deque
+import gc
+
+import numpy as np
 
 ZERO_LEN = 10 ** (-5)
 
-# initialize properties of input tree and return set containing taxa of leaves
-def prep(tree, support):
-    tree.resolve_polytomies()
-    tree.suppress_unifurcations()
-    for node in tree.traverse_postorder():
-        node.color = -1
-        if not hasattr(node, 'placements'):
-            node.placements = []
-            node.resolved_randomly = True
-        else:
-            node.resolved_randomly = False
-        if node.is_leaf():
-            pass
-        else:
-            try:
-                node.confidence = float(str(node))
-            except:
-                node.confidence = 100.0   # give edges without support values support 100
-            if node.confidence < support:   # don't allow low-support edges
-                node.edge_length = float('inf')
+
+def postorder(tree):
+    """nodes of ``tree`` in the order of ``Tree.traverse_postorder``"""
+    nodes = []
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    nodes.reverse()
+    return nodes
+
+
+def tree_to_arrays(tree, support, node_weight=None):
+    """
+    Initialize properties of the input tree (resolving polytomies and unifurcations if there are any) and return
+    its flat representation: the list of its nodes in postorder and lists, indexed by postorder position, of
+    the parent (the root is its own parent), the left and the right child (-1 for leaves), the edge length
+    (0 if missing), the number of placements and the weight of every node.
+    The weight of a node is ``node_weight(node)``, by default the number of its placements plus one for a leaf.
+    """
+    nodes = postorder(tree)
+    if any(len(node.children) not in (0, 2) for node in nodes):
+        tree.resolve_polytomies()
+        tree.suppress_unifurcations()
+        nodes = postorder(tree)
+    # the loop below allocates only small objects that are never garbage; pausing the cyclic garbage collector
+    # keeps it from repeatedly scanning all the nodes of the tree
+    gc_enabled = gc.isenabled()
+    n = len(nodes)
+    parent = list(range(n))
+    left = [-1] * n
+    right = [-1] * n
+    edge_length = [0.0] * n
+    num_placements = [0] * n
+    weight = [0] * n
+    size = [1] * n
+    try:
+        gc.disable()
+        for i, node in enumerate(nodes):
+            placements = getattr(node, 'placements', None)
+            if placements is None:
+                node.placements = []
+                node.resolved_randomly = True
+            else:
+                node.resolved_randomly = False
+                num_placements[i] = len(placements)
+            if node.children:
+                # in postorder, the right child directly precedes its parent, and the left child precedes the subtree
+                # of the right child
+                r = i - 1
+                l = r - size[r]
+                left[i], right[i] = l, r
+                parent[l] = parent[r] = i
+                size[i] += size[l] + size[r]
+                # give edges without support values support 100. with support 0 no edge can be filtered, so the labels
+                # are not parsed.
+                if support > 0 and node.label is not None:
+                    try:
+                        node.confidence = float(str(node))
+                    except:
+                        node.confidence = 100.0
+                    if node.confidence < support:  # don't allow low-support edges
+                        node.edge_length = float('inf')
+            if node.edge_length is not None:
+                edge_length[i] = node.edge_length
+            if node_weight is None:
+                weight[i] = num_placements[i] if node.children else num_placements[i] + 1
+            else:
+                weight[i] = node_weight(node)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return nodes, parent, left, right, edge_length, num_placements, weight
 
 
-def paint(node, color):
-    s = deque()
-    s.append(node)
-    while len(s) != 0:
-        n = s.pop()
-        if n.color < 0:
-            n.color = color
-            s.extend(n.children)
+def paint(parent, painted):
+    """
+    Colour of every node, given the colours of the painted nodes (-1 for the others). Painting a node colours
+    its subtree, except the parts already coloured by paints below it, so the colour of a node is the colour
+    of its nearest painted ancestor (or itself). These are found for all nodes at once by pointer jumping.
+    """
+    painted = np.asarray(painted)
+    nearest = np.where(painted >= 0, np.arange(len(painted)), np.asarray(parent))
+    while True:
+        jumped = nearest[nearest]
+        if np.array_equal(jumped, nearest):
+            break
+        nearest = jumped
+    return painted[nearest]
+
+
+def _apply_colors(nodes, colors):
+    for node, color in zip(nodes, colors.tolist()):
+        node.color = color
+    return colors, nodes
 
 
 def min_tree_coloring_sum(tree, thr):
-    prep(tree, 0)
+    nodes, parent, left, right, edge_length, num_placements, weight = tree_to_arrays(tree, 0)
+    weight[-1] = float('inf')
+    painted = [-1] * len(nodes)
     color = 0
-    for current in tree.traverse_postorder():
-        if current == tree.root:
-            current.weight = float('inf')
+    for current in range(len(nodes)):
+        l, r = left[current], right[current]
+        if l < 0:
+            continue
+        if weight[l] + weight[r] + weight[current] <= thr:
+            weight[current] += weight[l] + weight[r]
+        elif weight[l] + weight[r] <= thr:
+            painted[l] = painted[r] = color
+            color += 1
         else:
-            current.weight = len(current.placements)
-        if current.is_leaf():
-            current.weight += 1  # add leaf to it
-        else:
-            left, right = current.children
-            if left.weight + right.weight + current.weight <= thr:
-                current.weight += left.weight + right.weight
-            elif left.weight + right.weight <= thr:
-                paint(left, color)
-                paint(right, color)
-                color += 1
+            heavier, lighter = (l, r) if weight[l] > weight[r] else (r, l)
+            painted[heavier] = color
+            color += 1
+            if weight[lighter] + weight[current] <= thr:
+                weight[current] += weight[lighter]
             else:
-                heavier, lighter = (left, right) if left.weight > right.weight else (right, left)
-                paint(heavier, color)
+                painted[lighter] = color
                 color += 1
-                if lighter.weight + current.weight <= thr:
-                    current.weight += lighter.weight
-                else:
-                    paint(lighter, color)
-                    color += 1
+    return _apply_colors(nodes, paint(parent, painted))
 
 
-def min_tree_coloring_sum_max(tree, thr, max_thr):
-    prep(tree, 0)
+def coloring_sum_max(parent, left, right, edge_length, num_placements, weight, thr, max_thr):
+    """
+    Colours of the nodes of a tree given as flat arrays (see tree_to_arrays), computed as described in
+    min_tree_coloring_sum_max. The arrays are not modified, so they can be coloured with several thresholds.
+    """
+    root = len(parent) - 1
+    weight = list(weight)
+    weight[root] = float('inf')
+    farthest = [0.0] * len(parent)
+    painted = [-1] * len(parent)
     color = 0
-    for current in tree.traverse_postorder():
-        if current == tree.root:
-            current.weight = float('inf')
+    for current in range(len(parent)):
+        l, r = left[current], right[current]
+        if l < 0:
+            farthest[current] = 0
+            continue
+        wl, wr, wc = weight[l], weight[r], weight[current]
+        if (
+            wl + wr + wc <= thr
+            or (wl + wr + wc > thr and wl + wr <= max(3, thr / 10))
+            or edge_length[l] + farthest[l] + edge_length[r] + farthest[r] < max_thr
+            or (edge_length[l] <= ZERO_LEN and num_placements[l] > 0)
+            or (edge_length[r] <= ZERO_LEN and num_placements[r] > 0)
+            or (current != root and edge_length[current] <= ZERO_LEN and num_placements[current] > 0)
+        ):
+            weight[current] += wl + wr
+            farthest[current] = max(edge_length[l] + farthest[l], edge_length[r] + farthest[r])
+        elif wl + wr <= thr:
+            painted[l] = painted[r] = color
+            color += 1
+            farthest[current] = 0
         else:
-            current.weight = len(current.placements)
-        if current.is_leaf():
-            current.weight += 1  # add leaf to it
-            current.farthest = 0
-        else:
-            left, right = current.children
-            if (
-                left.weight + right.weight + current.weight <= thr
-                or (
-                    left.weight + right.weight + current.weight > thr and left.weight + right.weight <= max(3, thr / 10)
-                )
-                or left.edge_length + left.farthest + right.edge_length + right.farthest < max_thr
-                or (left.edge_length <= ZERO_LEN and len(left.placements) > 0)
-                or (right.edge_length <= ZERO_LEN and len(right.placements) > 0)
-                or (not current.is_root() and current.edge_length <= ZERO_LEN and len(current.placements) > 0)
-            ):
-                current.weight += left.weight + right.weight
-                current.farthest = max(left.edge_length + left.farthest, right.edge_length + right.farthest)
-            elif left.weight + right.weight <= thr:
-                paint(left, color)
-                paint(right, color)
-                color += 1
-                current.farthest = 0
+            heavier, lighter = (l, r) if wl > wr else (r, l)
+            painted[heavier] = color
+            color += 1
+            farthest[current] = farthest[lighter] + edge_length[lighter]
+            if weight[lighter] + wc <= thr:
+                weight[current] += weight[lighter]
             else:
-                heavier, lighter = (left, right) if left.weight > right.weight else (right, left)
-                paint(heavier, color)
+                painted[lighter] = color
                 color += 1
-                current.farthest = lighter.farthest + lighter.edge_length
-                if lighter.weight + current.weight <= thr:
-                    current.weight += lighter.weight
-                else:
-                    paint(lighter, color)
-                    color += 1
-                    current.farthest = 0
+                farthest[current] = 0
+    return paint(parent, painted)
+
+
+def min_tree_coloring_sum_max(tree, thr, max_thr, node_weight=None):
+    """
+    Colour ``tree`` so that every colour has a total weight of at most ``thr``, merging across short or
+    zero-length edges (see the merge conditions in coloring_sum_max). By default, the weight of a node is its
+    number of placements plus one for a leaf; ``node_weight`` gives other weights (see tree_to_arrays).
+    Sets ``node.color`` and returns the colour array and the list of nodes, both in postorder.
+    """
+    nodes, parent, left, right, edge_length, num_placements, weight = tree_to_arrays(tree, 0, node_weight)
+    colors = coloring_sum_max(parent, left, right, edge_length, num_placements, weight, thr, max_thr)
+    return _apply_colors(nodes, colors)
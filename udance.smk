@@ -15,6 +15,17 @@ TRIMMEDGENES = [os.path.join(outdir, "trimdump", f) for f in os.listdir(alndir)
 
 udance_logpath = os.path.abspath(os.path.join(wdr, "udance.log"))
 
+# fraction of the cores and memory of the incremental ASTRAL runs when both approaches run at the same time
+astral_split = float(config["refine_config"].get("astral_split", 0.5))
+astral_concurrent = 0 < astral_split < 1 and config["resources"]["cores"] > 1
+
+
+def astral_share(approach, total):
+    if not astral_concurrent:
+        return total
+    share = min(max(1, round(total * astral_split)), total - 1)
+    return share if approach == "incremental" else total - share
+
 localrules: all, clean, trimcollect, copybb
 
 rule all:
@@ -67,6 +78,7 @@ rule mainlines:
     params:
             n=config["mainlines_config"]["n"],
             l=config["mainlines_config"]["length"],
+            cache=config["mainlines_config"].get("cache_entries", 0),
             char=config["chartype"],
             bck=config["backbone"]
     resources: mem_mb=config["resources"]["large_memory"]
@@ -79,9 +91,11 @@ rule mainlines:
             elif [ "{params.bck}" == "tree" ]; then
                 nw_labels -I {input_bbone} > {output}
             elif [ "{params.char}" == "nuc" ]; then  # denovo
-                python run_udance.py mainlines -s {input} -n {params.n} -l {params.l} > {output}
+                python run_udance.py mainlines -s {input} -n {params.n} -l {params.l} --store-dir {outdir}/alignment_store \
+                --cache-dir {outdir}/mainlines_cache --cache-entries {params.cache} > {output}
             else
-                python run_udance.py mainlines -s {input} -n {params.n} -l {params.l} -p > {output}
+                python run_udance.py mainlines -s {input} -n {params.n} -l {params.l} -p --store-dir {outdir}/alignment_store \
+                --cache-dir {outdir}/mainlines_cache --cache-entries {params.cache} > {output}
             fi
             ) >> {udance_logpath} 2>&1
         """
@@ -135,14 +149,15 @@ if config["backbone"] != "tree":
             c=config["refine_config"]["contract"],
             occup = config["refine_config"]["occupancy"],
             ol=config["refine_config"]["outlier_sizelimit"],
-            od=config["refine_config"]["outlier_difference"]
+            od=config["refine_config"]["outlier_difference"],
+            split=astral_split
         resources: cpus=config["resources"]["cores"],
                    mem_mb=config["resources"]["large_memory"]
         benchmark: "%s/benchmarks/refine_copy_bb.txt" % outdir
         shell:
             '''
                 (
-                python run_udance.py refine -p {outdir}/backbone/0 -m {params.method} -M {resources.mem_mb} -c {params.c} -o {params.occup} -T {resources.cpus} -l {params.ol} -d {params.od}
+                python run_udance.py refine -p {outdir}/backbone/0 -m {params.method} -M {resources.mem_mb} -c {params.c} -o {params.occup} -T {resources.cpus} -l {params.ol} -d {params.od} -s {params.split}
                 nw_reroot -d {outdir}/backbone/0/astral_output.incremental.nwk > {output}
                 ) >> {udance_logpath} 2>&1
             '''
@@ -214,13 +229,16 @@ checkpoint decompose:
     output: cst=os.path.join(outdir,"udance/color_spanning_tree.nwk")
     params:
         size=config["prep_config"]["cluster_size"],
+        budget=config["prep_config"].get("budget", "none"),
         method=config["infer_config"]["method"],
         edg=config["prep_config"]["edge_thr"],
         sub=config["prep_config"]["sublength"],
         frag=config["prep_config"]["fraglength"],
         pra=config["prep_config"]["pruneafter"],
         mps=config["prep_config"]["min_placements"],
-        char=config["chartype"]
+        char=config["chartype"],
+        s=config["infer_config"]["numstart"],
+        thrd=config["infer_config"]["numthread"]
 
     resources: cpus=config["resources"]["cores"],
                mem_mb=config["resources"]["large_memory"]
@@ -238,16 +256,23 @@ checkpoint decompose:
                 clustsz="{params.size}"
                 echo "Cluster size is set to $clustsz (user-choice)"
             fi
+            budgetopt=""
+            if [ "{params.budget}" != "none" ]; then
+                budgetopt="-b {params.budget}"
+                echo "Clusters are formed by estimated cost with a budget of {params.budget} per partition"
+            fi
             if [ "{params.char}" == "nuc" ]; then
                 python run_udance.py decompose -s {input.ind} -o {outdir}/udance -t $clustsz -j {input.j} \
+                --store-dir {outdir}/alignment_store \
                 -m {params.method} -T {resources.cpus} -l {params.sub} -f {params.frag} -e {params.edg} \
-                --minplacements {params.mps}
+                --minplacements {params.mps} --numstart {params.s} --numthread {params.thrd} $budgetopt
             else
                 python run_udance.py decompose -p -s {input.ind} -o {outdir}/udance -t $clustsz -j {input.j} \
+                --store-dir {outdir}/alignment_store \
                 -m {params.method} -T {resources.cpus} -l {params.sub} -f {params.frag} -e {params.edg} \
-                --minplacements {params.mps}
+                --minplacements {params.mps} --numstart {params.s} --numthread {params.thrd} $budgetopt
             fi
-            python prune_similar.py -T {resources.cpus} -o {outdir}/udance -S {params.pra}
+            python prune_similar.py -T {resources.cpus} -M {resources.mem_mb} -o {outdir}/udance -S {params.pra}
             if [  -f {outdir}/udance/dedupe_map.txt ]; then 
                 cat {outdir}/udance/dedupe_map.txt > {outdir}/dedupe_map.txt 
             fi 
@@ -294,7 +319,8 @@ rule refine:
             c=config["refine_config"]["contract"],
             occup=config["refine_config"]["occupancy"],
             ol=config["refine_config"]["outlier_sizelimit"],
-            od=config["refine_config"]["outlier_difference"]
+            od=config["refine_config"]["outlier_difference"],
+            split=astral_split
     resources: cpus=config["resources"]["cores"],
                mem_mb=config["resources"]["large_memory"]
     benchmark: "%s/benchmarks/refine.{cluster}.txt" % outdir
@@ -302,32 +328,56 @@ rule refine:
     shell:
         """
             (
-            python run_udance.py refine -p {outdir}/udance/{wildcards.cluster} -m {params.method} -M {resources.mem_mb} -c {params.c} -o {params.occup} -T {resources.cpus} -l {params.ol} -d {params.od}
+            python run_udance.py refine -p {outdir}/udance/{wildcards.cluster} -m {params.method} -M {resources.mem_mb} -c {params.c} -o {params.occup} -T {resources.cpus} -l {params.ol} -d {params.od} -s {params.split}
             ) >> {udance_logpath} 2>&1
         """
 
 rule blinference:
     input: expand("%s/udance/{{cluster}}/astral_output.{approach}.nwk" % outdir, approach=["incremental", "updates"])
     output: expand("%s/udance/{{cluster}}/astral_output.{approach}.nwk.bl" % outdir, approach=["incremental", "updates"])
+    params: concurrent=astral_concurrent,
+            inct=astral_share("incremental", config["resources"]["cores"]),
+            incm=astral_share("incremental", config["resources"]["large_memory"]),
+            updt=astral_share("updates", config["resources"]["cores"]),
+            updm=astral_share("updates", config["resources"]["large_memory"])
     resources: cpus=config["resources"]["cores"],
                mem_mb=config["resources"]["large_memory"]
     benchmark: "%s/benchmarks/blinference.{cluster}.txt" % outdir
     shell:
         '''
             pwdd=`pwd`
-            for approach in incremental updates; do
+            # usage: blinference approach cores memory
+            blinference() {{
                 if [ -f  {outdir}/udance/{wildcards.cluster}/skip_partition ] ; then
-                    cp {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl
+                    cp {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl
                 else
-                    java -Xmx{resources.mem_mb}M -Djava.library.path=$pwdd/uDance/tools/ASTRAL/lib/ -jar $pwdd/uDance/tools/ASTRAL/astralmp.5.17.2.jar \
-                        -q {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk \
+                    java -Xmx$3M -Djava.library.path=$pwdd/uDance/tools/ASTRAL/lib/ -jar $pwdd/uDance/tools/ASTRAL/astralmp.5.17.2.jar \
+                        -q {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk \
                         -i {outdir}/udance/{wildcards.cluster}/astral_input.trees \
-                        -o {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl \
-                        -C -T {resources.cpus} -u > {outdir}/udance/{wildcards.cluster}/astral.$approach.log.bl 2>&1
-                    mv {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl.falsesupport
-                    python uDance/transfer_supports.py {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl.falsesupport > {outdir}/udance/{wildcards.cluster}/astral_output.$approach.nwk.bl
+                        -o {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl \
+                        -C -T $2 -u > {outdir}/udance/{wildcards.cluster}/astral.$1.log.bl 2>&1
+                    mv {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl.falsesupport
+                    python uDance/transfer_supports.py {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl.falsesupport > {outdir}/udance/{wildcards.cluster}/astral_output.$1.nwk.bl
                 fi
-            done
+            }}
+            if [ "{params.concurrent}" == "True" ]; then
+                blinference incremental {params.inct} {params.incm} &
+                incpid=$!
+                blinference updates {params.updt} {params.updm} &
+                updpid=$!
+                failed=0
+                for approach in incremental updates; do
+                    if [ $approach == incremental ]; then pid=$incpid; else pid=$updpid; fi
+                    if ! wait $pid; then
+                        echo "Branch length inference ($approach) on partition {wildcards.cluster} has failed. Check the log file {outdir}/udance/{wildcards.cluster}/astral.$approach.log.bl"
+                        failed=1
+                    fi
+                done
+                exit $failed
+            else
+                blinference incremental {params.inct} {params.incm}
+                blinference updates {params.updt} {params.updm}
+            fi
         '''
 
 def aggregate_stitch_input(wildcards):